@@ -19,6 +19,52 @@ ALLOWED_HOSTS = []
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Optional per-request profiling of the storage views (see storage/profiling.py).
+# Profile every request, or only a random fraction of them (0.0 - 1.0).
+STORAGE_PROFILING_ENABLED = os.environ.get('STORAGE_PROFILING_ENABLED') == '1'
+STORAGE_PROFILING_SAMPLE_RATE = float(os.environ.get('STORAGE_PROFILING_SAMPLE_RATE', '0'))
+STORAGE_PROFILING_CPROFILE = True # Dump a .prof file per profiled request
+STORAGE_PROFILING_TRACEMALLOC = True # Dump the top allocation sites per profiled request
+STORAGE_PROFILING_TOP_ALLOCATIONS = 25
+STORAGE_PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+
+# Maximum read rate (MB/s) of the `scrub_chunks` checksum verification command.
+STORAGE_SCRUB_RATE_MB = 20
+
+# Orphaned temp files, encrypted blobs and chunks older than this (seconds) are deleted by
+# `collect_orphans` (run it from cron). Set STORAGE_GC_INTERVAL (seconds) to also run it
+# periodically inside the server processes started through core/wsgi.py.
+STORAGE_GC_GRACE_PERIOD = 3600
+STORAGE_GC_INTERVAL = None
+
+# Default per-user quota on stored (encrypted) bytes; None for unlimited. A user's
+# StorageUsage.quota_bytes overrides it.
+STORAGE_QUOTA_BYTES = None
+
+# Wrong file keys allowed per user and file before further attempts get a 429 for the
+# rest of the window (seconds). Counts are kept in the database (storage.KeyAttempt), so
+# the limit holds across worker processes.
+STORAGE_KEY_ATTEMPT_LIMIT = 5
+STORAGE_KEY_ATTEMPT_WINDOW = 300
+
+# How decrypted downloads are sent (see storage/serving.py):
+#   'django'   - FileResponse, sent with sendfile() by Gunicorn (development default)
+#   'nginx'    - X-Accel-Redirect to STORAGE_SERVE_INTERNAL_URL, an `internal` location aliased to MEDIA_ROOT
+#   'sendfile' - X-Sendfile with the absolute path (Apache mod_xsendfile, lighttpd)
+STORAGE_SERVE_BACKEND = os.environ.get('STORAGE_SERVE_BACKEND', 'django')
+STORAGE_SERVE_INTERNAL_URL = '/protected/'
+STORAGE_SERVE_TOKEN_MAX_AGE = 60 # Seconds a download link stays valid
+
+# Admission control for encryption/decryption jobs (see storage/admission.py). Limits hold
+# across all Gunicorn workers through file locks in STORAGE_CRYPTO_LOCK_DIR. Files of at least
+# STORAGE_CRYPTO_LARGE_FILE_BYTES use the 'large' lane, so they never take the small files' slots.
+STORAGE_CRYPTO_LOCK_DIR = os.path.join(BASE_DIR, 'run', 'admission')
+STORAGE_CRYPTO_LARGE_FILE_BYTES = 1024 * 1024
+STORAGE_CRYPTO_SLOTS = {'small': 4, 'large': 2} # Jobs running at once per lane
+STORAGE_CRYPTO_USER_SLOTS = 2 # Jobs running at once per user, over both lanes
+STORAGE_CRYPTO_QUEUE_SIZE = {'small': 32, 'large': 8} # Jobs allowed to wait per lane before answering 429
+STORAGE_CRYPTO_QUEUE_TIMEOUT = 30 # Seconds a job may wait before answering 429
+
 
 # Application definition
 
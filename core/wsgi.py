@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_wsgi_application()
+
+# Optional in-process orphan collection, started only in processes that serve requests (management
+# commands such as migrate or collect_orphans never import this module). Without --preload, every
+# Gunicorn worker starts a thread; a file lock keeps them from collecting at the same time.
+from django.conf import settings
+
+if getattr(settings, 'STORAGE_GC_INTERVAL', None):
+    from storage.janitor import start_scheduler
+    start_scheduler(settings.STORAGE_GC_INTERVAL)
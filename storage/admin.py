@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import StorageUsage
 
 # Register your models here.
+@admin.register(StorageUsage)
+class StorageUsageAdmin(admin.ModelAdmin):
+    list_display = ('username', 'file_count', 'stored_bytes', 'quota_bytes')
+    search_fields = ('username',)
+    readonly_fields = ('file_count', 'plaintext_bytes', 'ciphertext_bytes', 'stored_bytes') # Maintained by the views
@@ -0,0 +1,254 @@
+# storage/admission.py
+import contextlib
+import fcntl
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from django.conf import settings
+
+LANES = ('small', 'large')
+NAMED_LOCK_BUCKETS = 256 # Lock files behind exclusive()
+
+
+class AdmissionRejected(Exception):
+    """Raised when crypto work cannot be admitted; the view answers 429 with Retry-After."""
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Crypto work rejected ({reason}), retry after {retry_after}s")
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _lock_dir(*parts):
+    path = os.path.join(_setting('STORAGE_CRYPTO_LOCK_DIR', os.path.join(settings.BASE_DIR, 'run', 'admission')), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def lane_for(size):
+    """Lane for a job on a file of `size` plaintext bytes."""
+    return 'large' if size >= _setting('STORAGE_CRYPTO_LARGE_FILE_BYTES', 1024 * 1024) else 'small'
+
+
+def _lane_limit(setting_name, lane, default):
+    value = _setting(setting_name, default)
+    return value[lane] if isinstance(value, dict) else value
+
+
+def _slot_paths(directory, prefix, count):
+    return [os.path.join(directory, f"{prefix}_{i}.lock") for i in range(count)]
+
+
+def _try_lock_any(paths):
+    """
+    Takes a non-blocking exclusive flock on the first free file of `paths`.
+
+    flock locks belong to the open file, so they work between threads and between worker
+    processes alike, and the kernel drops them if a worker dies. Returns the open file or None.
+    """
+    for path in random.sample(paths, len(paths)): # Random order spreads contention over the slots
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            lock_file.close()
+    return None
+
+
+def _paths(lane, username=None):
+    """Returns (queue ticket paths, running slot paths, per-user slot paths) for a lane."""
+    lane_dir = _lock_dir(lane)
+    queue_paths = _slot_paths(lane_dir, 'queue', _lane_limit('STORAGE_CRYPTO_QUEUE_SIZE', lane, 16))
+    slot_paths = _slot_paths(lane_dir, 'slot', _lane_limit('STORAGE_CRYPTO_SLOTS', lane, 2))
+    user_paths = []
+    if username is not None:
+        user_key = hashlib.blake2b(username.encode(), digest_size=8).hexdigest()
+        user_paths = _slot_paths(_lock_dir('users'), user_key, _setting('STORAGE_CRYPTO_USER_SLOTS', 1))
+    return queue_paths, slot_paths, user_paths
+
+
+@contextlib.contextmanager
+def exclusive(name):
+    """
+    Blocking exclusive lock called `name`, shared by all worker processes.
+
+    Names are hashed into NAMED_LOCK_BUCKETS lock files, so the lock directory stays the same
+    size however many names are used. Two names can share a bucket, which only serializes them.
+    """
+    bucket = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'big') % NAMED_LOCK_BUCKETS
+    with open(os.path.join(_lock_dir('named'), f"bucket_{bucket}.lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# --- Shared metrics, kept in a small JSON file so every worker process contributes ---
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Exists, owned by another user
+    return True
+
+
+def _live_totals(stats, lane):
+    """
+    Queued and running jobs in a lane, summed over the worker processes that are still alive.
+
+    Each process keeps its own counts under stats['live'][pid], so the counts of a worker that
+    died mid-job are dropped (and pruned on the next write) instead of inflating the totals.
+    """
+    totals = {'queued': 0, 'running': 0}
+    live = stats.get('live', {})
+    for pid in list(live):
+        if not _pid_alive(int(pid)):
+            del live[pid]
+            continue
+        for key in totals:
+            totals[key] += live[pid].get(lane, {}).get(key, 0)
+    return totals
+
+
+def _update_stats(lane, outcome=None, waited=0.0, service=None, queued=0, running=0):
+    """
+    Updates the shared counters under the stats file's flock.
+
+    Besides counting `outcome`, this moves this process's queued/running job counts by
+    `queued` and `running`. Returns the lane's live totals after the update.
+    """
+    stats_path = os.path.join(_lock_dir(), 'stats.json')
+    with open(stats_path, 'a+') as stats_file:
+        fcntl.flock(stats_file, fcntl.LOCK_EX)
+        stats_file.seek(0)
+        try:
+            stats = json.loads(stats_file.read() or '{}')
+        except ValueError:
+            stats = {}
+        lane_stats = stats.setdefault(lane, {})
+        if outcome is not None:
+            lane_stats[outcome] = lane_stats.get(outcome, 0) + 1
+        if outcome == 'admitted':
+            lane_stats['wait_seconds_total'] = lane_stats.get('wait_seconds_total', 0.0) + waited
+            lane_stats['wait_seconds_max'] = max(lane_stats.get('wait_seconds_max', 0.0), waited)
+        if service is not None: # Exponentially weighted average, used to estimate Retry-After
+            previous = lane_stats.get('service_seconds_avg')
+            lane_stats['service_seconds_avg'] = service if previous is None else 0.8 * previous + 0.2 * service
+        if queued or running:
+            process_stats = stats.setdefault('live', {}).setdefault(str(os.getpid()), {})
+            counts = process_stats.setdefault(lane, {})
+            counts['queued'] = counts.get('queued', 0) + queued
+            counts['running'] = counts.get('running', 0) + running
+            if not any(counts.values()):
+                del process_stats[lane]
+            if not process_stats:
+                del stats['live'][str(os.getpid())]
+        totals = _live_totals(stats, lane)
+        stats_file.seek(0)
+        stats_file.truncate()
+        stats_file.write(json.dumps(stats))
+    return totals
+
+
+def _read_stats():
+    try:
+        with open(os.path.join(_lock_dir(), 'stats.json')) as stats_file:
+            return json.loads(stats_file.read() or '{}')
+    except (OSError, ValueError):
+        return {}
+
+
+def _retry_after(lane, queued, slots):
+    """Seconds until a retry is likely to be admitted: queued jobs x average job time / slots."""
+    service = _read_stats().get(lane, {}).get('service_seconds_avg', 1.0)
+    return max(1, math.ceil(service * (queued + 1) / max(slots, 1)))
+
+
+def metrics():
+    """Snapshot per lane: running and queued jobs plus the shared counters, all from the stats file."""
+    snapshot = {}
+    stats = _read_stats()
+    for lane in LANES:
+        queue_paths, slot_paths, _ = _paths(lane)
+        lane_stats = dict(stats.get(lane, {}))
+        admitted = lane_stats.get('admitted', 0)
+        lane_stats.update(_live_totals(stats, lane))
+        lane_stats.update({
+            'slots': len(slot_paths),
+            'queue_size': len(queue_paths),
+            'wait_seconds_avg': lane_stats.get('wait_seconds_total', 0.0) / admitted if admitted else 0.0,
+        })
+        snapshot[lane] = lane_stats
+    return snapshot
+
+
+@contextlib.contextmanager
+def admit(username, size):
+    """
+    Waits for permission to run an encryption/decryption job, across all worker processes.
+
+    A job needs a slot in its lane (small or large files, so large uploads cannot starve small
+    ones) and one of the user's slots (so one user cannot take over a lane). While it waits it
+    holds a queue ticket; when the lane's queue is full, or the wait exceeds
+    STORAGE_CRYPTO_QUEUE_TIMEOUT, AdmissionRejected is raised instead.
+
+    Args:
+        username (str): Owner of the job.
+        size (int): Plaintext size in bytes, used to pick the lane.
+    """
+    lane = lane_for(size)
+    queue_paths, slot_paths, user_paths = _paths(lane, username)
+
+    ticket = _try_lock_any(queue_paths)
+    if ticket is None:
+        _update_stats(lane, 'rejected_queue_full')
+        raise AdmissionRejected('queue full', _retry_after(lane, len(queue_paths), len(slot_paths)))
+    _update_stats(lane, queued=1)
+
+    started = time.monotonic()
+    deadline = started + _setting('STORAGE_CRYPTO_QUEUE_TIMEOUT', 30)
+    delay = 0.01
+    user_slot = slot = None
+    outcome = None
+    try:
+        while True:
+            user_slot = _try_lock_any(user_paths)
+            if user_slot is not None:
+                slot = _try_lock_any(slot_paths)
+                if slot is not None:
+                    break
+                user_slot.close() # Do not hold the user's slot while waiting for the lane
+                user_slot = None
+            if time.monotonic() + delay > deadline:
+                outcome = 'rejected_timeout'
+                break
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 0.25)
+    finally:
+        ticket.close() # Leave the queue, whether admitted or not
+        if slot is None:
+            totals = _update_stats(lane, outcome, queued=-1)
+    if slot is None:
+        raise AdmissionRejected('timed out in queue', _retry_after(lane, totals['queued'], len(slot_paths)))
+
+    waited = time.monotonic() - started
+    _update_stats(lane, 'admitted', waited=waited, queued=-1, running=1)
+    if waited > 0.1:
+        print(f"Admission: {lane} job for {username} waited {waited:.2f}s")
+    try:
+        yield lane
+    finally:
+        slot.close()
+        user_slot.close()
+        _update_stats(lane, 'completed', service=time.monotonic() - started - waited, running=-1)
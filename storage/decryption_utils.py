@@ -1,5 +1,8 @@
+import mmap
 import os
 from django.conf import settings
+from .integrity import ChunkIntegrityError, PlaintextIntegrityError, SegmentVerifier, new_hasher
+from .io_utils import COPY_BLOCK_SIZE, copy_range, iter_blocks
 
 # --- Helper Functions (decimal_to_binary, is_repeating_string, extended_gcd) ---
 def decimal_to_binary(number):
@@ -34,20 +37,59 @@ def extended_gcd(a, b):
          return (gcd_val, y - (b // a) * x, x)
 
 # --- File Combining Function ---
-def combine_files(part_paths, output_filepath):
-    """Combines file parts back into a single file."""
+def _append_verified(infile, outfile, part_rel_path, expected_digest):
+    """Appends a part to outfile through an mmap, hashing it as it goes, and checks the digest."""
+    hasher = new_hasher()
+    part_size = os.fstat(infile.fileno()).st_size
+    if part_size:
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for start in range(0, part_size, COPY_BLOCK_SIZE):
+                    end = start + COPY_BLOCK_SIZE
+                    hasher.update(view[start:end])
+                    outfile.write(view[start:end])
+    outfile.flush()
+    actual_digest = hasher.hexdigest()
+    if actual_digest != expected_digest:
+        raise ChunkIntegrityError(part_rel_path, expected_digest, actual_digest)
+
+
+def combine_files(part_paths, output_filepath, chunk_digests=None):
+    """
+    Combines file parts back into a single file.
+
+    If chunk_digests is given (one digest per non-empty part path), every part is hashed while
+    it is copied and a ChunkIntegrityError is raised at the first part that does not match, so
+    corruption is reported before any decryption work starts.
+
+    Returns:
+        bool: True if the parts were combined, False if a part is missing or unreadable.
+    """
     os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+    digests = iter(chunk_digests or [])
     try:
         with open(output_filepath, "wb") as outfile:
             for part_rel_path in part_paths:
                 if part_rel_path: # Ensure path is not None
                     part_full_path = os.path.join(settings.MEDIA_ROOT, part_rel_path)
                     if os.path.exists(part_full_path):
+                        expected_digest = next(digests, None)
                         with open(part_full_path, "rb") as infile:
-                            outfile.write(infile.read())
+                            if expected_digest:
+                                _append_verified(infile, outfile, part_rel_path, expected_digest)
+                            else: # Files uploaded before checksums were recorded
+                                part_size = os.fstat(infile.fileno()).st_size
+                                copied = copy_range(infile.fileno(), outfile.fileno(), 0, part_size)
+                                if copied != part_size:
+                                    raise OSError(f"Short copy for {part_full_path}: {copied} of {part_size} bytes")
                     else:
                          raise FileNotFoundError(f"Chunk not found: {part_full_path}")
         return True
+    except ChunkIntegrityError as e:
+        print(f"Error combining files: {e}")
+        if os.path.exists(output_filepath):
+             os.remove(output_filepath)
+        raise
     except Exception as e:
         print(f"Error combining files: {e}")
         # Clean up incomplete combined file
@@ -57,7 +99,7 @@ def combine_files(part_paths, output_filepath):
 
 
 # --- Main Decryption Function ---
-def decrypt_file(encrypted_filepath, decrypted_output_path, p, q):
+def decrypt_file(encrypted_filepath, decrypted_output_path, p, q, plaintext_segments=None):
     """
     Decrypts a file encrypted with Rabin's cryptosystem.
 
@@ -66,9 +108,15 @@ def decrypt_file(encrypted_filepath, decrypted_output_path, p, q):
         decrypted_output_path (str): Path to save the decrypted file.
         p (int): User's key (prime p).
         q (int): Stored key part (prime q).
+        plaintext_segments (list): Optional (size, hex digest) pairs recorded when the plaintext
+            was stored. The output is hashed as it is written and checked against them.
 
     Returns:
         bool: True if decryption is successful, False otherwise.
+
+    Raises:
+        PlaintextIntegrityError: If the output does not match plaintext_segments; the output
+            file is removed first.
     """
     n = p * q
 
@@ -80,27 +128,33 @@ def decrypt_file(encrypted_filepath, decrypted_output_path, p, q):
 
     os.makedirs(os.path.dirname(decrypted_output_path), exist_ok=True)
 
+    # Compute square roots modulo p and q [cite: 4]
+    # Ensure p and q are 3 mod 4 for this formula to work easily
+    if p % 4 != 3 or q % 4 != 3:
+         print("Error: Decryption requires primes p and q to be congruent to 3 mod 4.")
+         # Need a more general square root algorithm (Tonelli-Shanks) if this is not guaranteed
+         return False
+
+    exponent_p = (p + 1) // 4 # [cite: 4]
+    exponent_q = (q + 1) // 4 # [cite: 5]
+
+    verifier = SegmentVerifier(plaintext_segments) if plaintext_segments else None
+
+    def write_plain(output, data):
+        output.write(data)
+        if verifier is not None:
+            verifier.update(data)
+
     try:
-        with open(encrypted_filepath, "r") as cypher_file, open(decrypted_output_path, "wb") as decrypt_file: # Write bytes
-            while True:
-                cypher_bits = cypher_file.read(32) # [cite: 4]
-                if not cypher_bits: # [cite: 4]
-                    break # [cite: 4]
+        # The ciphertext is memory-mapped and read one 32-bit block at a time
+        with open(encrypted_filepath, "rb") as cypher_file, open(decrypted_output_path, "wb") as decrypt_file: # Write bytes
+            for cypher_bits in iter_blocks(cypher_file, 32): # [cite: 4]
                 if len(cypher_bits) < 32:
-                     print(f"Warning: Trailing non-32-bit chunk ignored: '{cypher_bits}'")
+                     print(f"Warning: Trailing non-32-bit chunk ignored: '{cypher_bits.decode('latin-1')}'")
                      break # Ignore incomplete chunk at the end
 
                 c = int(cypher_bits, 2) # [cite: 4]
 
-                # Compute square roots modulo p and q [cite: 4]
-                # Ensure p and q are 3 mod 4 for this formula to work easily
-                if p % 4 != 3 or q % 4 != 3:
-                     print("Error: Decryption requires primes p and q to be congruent to 3 mod 4.")
-                     # Need a more general square root algorithm (Tonelli-Shanks) if this is not guaranteed
-                     return False
-
-                exponent_p = (p + 1) // 4 # [cite: 4]
-                exponent_q = (q + 1) // 4 # [cite: 5]
                 r = pow(c, exponent_p, p) # [cite: 5]
                 s = pow(c, exponent_q, q) # [cite: 5]
 
@@ -119,7 +173,7 @@ def decrypt_file(encrypted_filepath, decrypted_output_path, p, q):
                              # Convert bits to int, then to char, then encode back to bytes
                              decrypted_char_code = int(plain_bits, 2) # [cite: 7]
                              decrypted_char = chr(decrypted_char_code) # [cite: 7]
-                             decrypt_file.write(decrypted_char.encode('latin-1')) # Write as bytes
+                             write_plain(decrypt_file, decrypted_char.encode('latin-1')) # Write as bytes
                              found = True # [cite: 8]
                              break # [cite: 8]
                         except (ValueError, OverflowError):
@@ -128,19 +182,25 @@ def decrypt_file(encrypted_filepath, decrypted_output_path, p, q):
                         except UnicodeEncodeError:
                             print(f"Warning: Could not encode character with code {decrypted_char_code} to latin-1.")
                             # Write a replacement byte sequence if needed
-                            decrypt_file.write(b'?') # Example: write a question mark byte
+                            write_plain(decrypt_file, b'?') # Example: write a question mark byte
                             found = True
                             break
 
 
                 if not found: # [cite: 8]
                     print(f"Warning: No valid repeating pattern found for ciphertext block {c}. Writing replacement.")
-                    decrypt_file.write(b'?') # Write a replacement byte [cite: 8]
+                    write_plain(decrypt_file, b'?') # Write a replacement byte [cite: 8]
 
+            if verifier is not None:
+                verifier.finish()
 
         print(f"Decryption successful. Decrypted file: {decrypted_output_path}")
         return True
 
+    except PlaintextIntegrityError:
+        if os.path.exists(decrypted_output_path):
+             os.remove(decrypted_output_path)
+        raise
     except FileNotFoundError:
          print(f"Error: Encrypted file not found at {encrypted_filepath}")
          return False
@@ -1,6 +1,11 @@
 import random
 import os
 from django.conf import settings # To use MEDIA_ROOT
+from .integrity import hash_range
+from .io_utils import copy_range
+
+# Every plaintext byte is written as one zero-padded 32-bit binary string
+CYPHER_BLOCK_SIZE = 32
 
 # --- Helper Functions (generate_primes, decimal_to_binary) ---
 def generate_primes(min_prime=1000, max_prime=10000):
@@ -16,6 +21,23 @@ def decimal_to_binary(number):
     # ... (keep the function as provided) [cite: 10]
     return format(number, 'b')
 
+def _write_cyphertext(plain_file, cypher_file, n):
+    """Encrypts every byte of plain_file with modulus n and writes the 32-bit blocks to cypher_file."""
+    while True:
+        byte = plain_file.read(1)
+        if not byte:
+            break
+        char = byte.decode('latin-1') # Read as bytes, decode carefully
+        ascii_val = ord(char) # [cite: 12]
+        binary_str = decimal_to_binary(ascii_val) # [cite: 12]
+        extended_binary = binary_str + binary_str # [cite: 12]
+
+        m = int(extended_binary, 2) # [cite: 12]
+        c = pow(m, 2, n) # [cite: 12] # Modular exponentiation
+
+        cypher_bits = decimal_to_binary(c).zfill(CYPHER_BLOCK_SIZE) # [cite: 13] # Pad to 32 bits
+        cypher_file.write(cypher_bits) # [cite: 13]
+
 # --- Main Encryption Function ---
 def encrypt_file(input_filepath, output_filename_base):
     """
@@ -42,20 +64,7 @@ def encrypt_file(input_filepath, output_filename_base):
 
     try:
         with open(input_filepath, "rb") as plain_file, open(encrypted_file_path, "w") as cypher_file:
-            while True:
-                byte = plain_file.read(1)
-                if not byte:
-                    break
-                char = byte.decode('latin-1') # Read as bytes, decode carefully
-                ascii_val = ord(char) # [cite: 12]
-                binary_str = decimal_to_binary(ascii_val) # [cite: 12]
-                extended_binary = binary_str + binary_str # [cite: 12]
-
-                m = int(extended_binary, 2) # [cite: 12]
-                c = pow(m, 2, n) # [cite: 12] # Modular exponentiation
-
-                cypher_bits = decimal_to_binary(c).zfill(32) # [cite: 13] # Pad to 32 bits
-                cypher_file.write(cypher_bits) # [cite: 13]
+            _write_cyphertext(plain_file, cypher_file, n)
 
         print(f"Encryption successful. Encrypted file: {encrypted_file_path}")
         print(f"User Key (p): {p}, Stored Key Part (q): {q}, Modulus (n): {n}")
@@ -68,33 +77,75 @@ def encrypt_file(input_filepath, output_filename_base):
             os.remove(encrypted_file_path)
         return None, None, None, None
 
+# --- Append Encryption Function ---
+def encrypt_append(input_filepath, part_filepath, n):
+    """
+    Encrypts bytes to be appended to an existing file, using that file's modulus.
+
+    Rabin encryption here works byte by byte, so the new bytes are encrypted on their own and
+    stored as an extra part after the existing ones; nothing already stored is touched.
+
+    Args:
+        input_filepath (str): Path to the plaintext to append.
+        part_filepath (str): Path of the new part to write. It must not be one of the file's
+            recorded parts; a leftover from an append that crashed before it was recorded is
+            overwritten.
+        n (int): Modulus of the existing file (p * q).
+
+    Returns:
+        bool: True if the part was written, False otherwise.
+    """
+    try:
+        with open(input_filepath, "rb") as plain_file, open(part_filepath, "w") as cypher_file:
+            _write_cyphertext(plain_file, cypher_file, n)
+        return True
+    except Exception as e:
+        print(f"Append encryption failed: {e}")
+        if os.path.exists(part_filepath):
+            os.remove(part_filepath)
+        return False
+
 # --- File Splitting Function ---
 def split_file(filepath, num_parts=3):
-    """Splits a file into multiple parts."""
+    """
+    Splits a file into multiple parts and hashes each part.
+
+    Returns:
+        tuple: (location1, location2, location3, chunk_digests) or four Nones on failure.
+               Locations are relative to MEDIA_ROOT (None for parts that were not needed),
+               chunk_digests holds the BLAKE2b hex digest of each created part, in order.
+    """
     chunk_dir = os.path.join(settings.MEDIA_ROOT, 'chunks', os.path.basename(filepath).replace('.enc', ''))
     os.makedirs(chunk_dir, exist_ok=True)
     part_paths = []
+    chunk_digests = []
     try:
         filesize = os.path.getsize(filepath)
         chunksize = (filesize + num_parts - 1) // num_parts # Ceiling division
 
         with open(filepath, "rb") as f:
             for i in range(num_parts):
-                chunk = f.read(chunksize)
-                if not chunk:
+                offset = i * chunksize
+                if offset >= filesize:
                     break
                 part_filename = os.path.join(chunk_dir, f"part_{i+1}")
-                with open(part_filename, "wb") as part_file:
-                    part_file.write(chunk)
-                # Store relative path from MEDIA_ROOT
+                part_size = min(chunksize, filesize - offset)
+                # Store relative path from MEDIA_ROOT (recorded first, so a failed part is cleaned up too)
                 relative_path = os.path.relpath(part_filename, settings.MEDIA_ROOT)
                 part_paths.append(relative_path)
+                # Copy the byte range in the kernel instead of reading it into memory
+                with open(part_filename, "w+b") as part_file:
+                    copied = copy_range(f.fileno(), part_file.fileno(), offset, part_size)
+                    if copied != part_size:
+                        raise OSError(f"Short copy for {part_filename}: {copied} of {part_size} bytes")
+                    # Hash the part as written, so the digest describes what is actually stored
+                    chunk_digests.append(hash_range(part_file, 0, part_size))
 
         # Pad part_paths if fewer parts were created (e.g., small file)
         while len(part_paths) < num_parts:
             part_paths.append(None) # Or handle as needed
 
-        return part_paths[0], part_paths[1], part_paths[2]
+        return part_paths[0], part_paths[1], part_paths[2], chunk_digests
     except Exception as e:
         print(f"Error splitting file: {e}")
         # Clean up created chunks if error occurs
@@ -106,4 +157,4 @@ def split_file(filepath, num_parts=3):
                 os.rmdir(chunk_dir) # Remove dir only if empty
             except OSError:
                 pass # Directory might not be empty if cleanup failed partially
-        return None, None, None
\ No newline at end of file
+        return None, None, None, None
\ No newline at end of file
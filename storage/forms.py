@@ -38,4 +38,19 @@ class UploadForm(forms.Form):
 
 class DownloadForm(forms.Form):
     file_id = forms.IntegerField(widget=forms.HiddenInput())
-    file_key = forms.CharField(label="Enter File Key", widget=forms.PasswordInput(attrs={'placeholder': 'Your Secret Key (p)'}))
\ No newline at end of file
+    file_key = forms.CharField(label="Enter File Key", widget=forms.PasswordInput(attrs={'placeholder': 'Your Secret Key (p)'}))
+
+
+class AppendForm(forms.Form):
+    file_key = forms.CharField(label="Enter File Key", widget=forms.PasswordInput(attrs={'placeholder': 'Your Secret Key (p)'}))
+    file = forms.FileField(label="Select .txt File to Append")
+
+    def clean_file(self):
+        """Validate that the appended file is a non-empty .txt file, like uploads."""
+        file = self.cleaned_data.get('file')
+        if file is not None:
+            if os.path.splitext(file.name)[1].lower() != '.txt':
+                raise ValidationError("Invalid file type. Only .txt files are allowed.")
+            if file.size == 0:
+                raise ValidationError("The file to append is empty.")
+        return file
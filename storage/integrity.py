@@ -0,0 +1,142 @@
+# storage/integrity.py
+import hashlib
+import mmap
+import os
+import time
+
+DIGEST_SIZE = 32 # BLAKE2b-256, stored as 64 hex characters
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class ChunkIntegrityError(Exception):
+    """Raised when a stored chunk does not match the digest recorded at upload time."""
+
+    def __init__(self, part_path, expected, actual):
+        self.part_path = part_path
+        self.expected = expected
+        self.actual = actual
+        super().__init__(f"Checksum mismatch for {part_path}: expected {expected}, got {actual}")
+
+
+class PlaintextIntegrityError(Exception):
+    """Raised when decrypted output does not match the plaintext digest recorded for it."""
+
+    def __init__(self, segment, expected, actual):
+        self.segment = segment
+        self.expected = expected
+        self.actual = actual
+        super().__init__(f"Plaintext checksum mismatch in segment {segment}: expected {expected}, got {actual}")
+
+
+def new_hasher():
+    """Returns the hash object used for all stored digests."""
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def root_digest(chunk_digests):
+    """
+    Whole-ciphertext digest: BLAKE2b over the concatenated per-chunk digests, in order.
+
+    Deriving it from the chunk digests means it is known as soon as the chunks are hashed
+    and can be extended when chunks are added, without re-reading any data.
+    """
+    hasher = new_hasher()
+    for digest in chunk_digests:
+        hasher.update(bytes.fromhex(digest))
+    return hasher.hexdigest()
+
+
+class SegmentVerifier:
+    """
+    Hashes a stream of output bytes and checks it against consecutive (size, digest) segments.
+
+    update() raises PlaintextIntegrityError as soon as a segment is complete and does not
+    match; finish() checks that the stream ended exactly at the end of the last segment.
+    """
+
+    def __init__(self, segments):
+        self.segments = [(int(size), digest) for size, digest in segments]
+        self.index = 0
+        self.remaining = self.segments[0][0] if self.segments else 0
+        self.hasher = new_hasher()
+
+    def _check_segment(self):
+        expected = self.segments[self.index][1]
+        actual = self.hasher.hexdigest()
+        if actual != expected:
+            raise PlaintextIntegrityError(self.index, expected, actual)
+        self.index += 1
+        self.remaining = self.segments[self.index][0] if self.index < len(self.segments) else 0
+        self.hasher = new_hasher()
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            if self.index >= len(self.segments):
+                raise PlaintextIntegrityError(self.index, '', 'unexpected trailing data')
+            take = min(self.remaining, len(data))
+            self.hasher.update(data[:take])
+            self.remaining -= take
+            data = data[take:]
+            if self.remaining == 0:
+                self._check_segment()
+
+    def finish(self):
+        # Segments that are still open (or empty and never reached) are checked here
+        while self.index < len(self.segments):
+            if self.remaining:
+                raise PlaintextIntegrityError(self.index, self.segments[self.index][1], 'truncated output')
+            self._check_segment()
+
+
+class RateLimiter:
+    """Sleeps as needed to keep the bytes passed to consume() at or below a given rate."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.consumed = 0
+        self.started = time.monotonic()
+
+    def consume(self, nbytes):
+        self.consumed += nbytes
+        ahead = self.consumed / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def hash_range(file_obj, offset, count):
+    """Digest of `count` bytes at `offset` of an open file, hashed through an mmap of it."""
+    hasher = new_hasher()
+    if count > 0:
+        with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                hasher.update(view[offset:offset + count])
+    return hasher.hexdigest()
+
+
+def hash_file(filepath, rate_limiter=None):
+    """
+    Computes the digest of a file by hashing memory-mapped windows of it.
+
+    Args:
+        filepath (str): Path of the file to hash.
+        rate_limiter (RateLimiter): Optional limiter to throttle the read rate.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    hasher = new_hasher()
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hasher.hexdigest() # mmap cannot map empty files
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start in range(0, size, HASH_BLOCK_SIZE):
+                    hasher.update(view[start:start + HASH_BLOCK_SIZE])
+                    if rate_limiter is not None:
+                        rate_limiter.consume(min(HASH_BLOCK_SIZE, size - start))
+            finally:
+                view.release()
+    return hasher.hexdigest()
@@ -0,0 +1,73 @@
+# storage/io_utils.py
+import mmap
+import os
+
+# Upper bound for a single kernel copy / write call, keeps each syscall bounded.
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copies `count` bytes starting at `offset` in src_fd to the current position of dst_fd.
+
+    The data is moved with os.copy_file_range or os.sendfile where the platform and
+    filesystem support them, so it never passes through Python buffers. Otherwise it
+    falls back to writing memoryview slices of an mmap of the source file.
+
+    Args:
+        src_fd (int): File descriptor to read from (its position is not used or changed).
+        dst_fd (int): File descriptor to write to, at its current position.
+        offset (int): Offset in the source file to start copying from.
+        count (int): Number of bytes to copy.
+
+    Returns:
+        int: Number of bytes copied (less than `count` if the source ends early).
+    """
+    end = offset + count
+    start = offset
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src_fd, dst_fd, min(end - offset, COPY_BLOCK_SIZE), offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            pass # Not supported for this pair of files (e.g. EXDEV), continue below
+
+    if offset < end and hasattr(os, 'sendfile'):
+        try:
+            while offset < end:
+                sent = os.sendfile(dst_fd, src_fd, offset, min(end - offset, COPY_BLOCK_SIZE))
+                if not sent:
+                    break
+                offset += sent
+        except OSError:
+            pass
+
+    if offset < end and os.fstat(src_fd).st_size > offset:
+        with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as mapped:
+            end = min(end, len(mapped))
+            view = memoryview(mapped)
+            try:
+                while offset < end:
+                    offset += os.write(dst_fd, view[offset:min(end, offset + COPY_BLOCK_SIZE)])
+            finally:
+                view.release()
+
+    return offset - start
+
+
+def iter_blocks(file_obj, block_size):
+    """
+    Yields consecutive `block_size`-byte blocks (the last one may be shorter) of an open file.
+
+    The file is memory-mapped, so only the current block is ever copied onto the Python heap
+    and peak memory does not grow with the file size.
+    """
+    if os.fstat(file_obj.fileno()).st_size == 0:
+        return # mmap cannot map empty files
+    with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start in range(0, len(mapped), block_size):
+            yield mapped[start:start + block_size]
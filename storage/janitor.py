@@ -0,0 +1,146 @@
+# storage/janitor.py
+import fcntl
+import os
+import shutil
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from .models import UserFile
+
+# Working directories under MEDIA_ROOT whose contents are only needed while a request runs
+TEMP_DIRS = ('temp', 'temp_combined', 'temp_decrypted', 'served')
+
+_scheduler_started = False
+_scheduler_lock = threading.Lock()
+
+
+def _tree_stats(path):
+    """Returns (total bytes, newest mtime) of everything under a directory."""
+    total, newest = 0, os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue # Removed concurrently
+            total += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return total, newest
+
+
+def _remove(path, size, dry_run, removed):
+    """Deletes a file or directory tree and records it in `removed` as (path, bytes)."""
+    if not dry_run:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            print(f"Janitor: could not remove {path}: {e}")
+            return
+    removed.append((path, size))
+
+
+def collect_orphans(grace_period=None, dry_run=False):
+    """
+    Deletes files under MEDIA_ROOT that no UserFile refers to and that are older than the grace period.
+
+    This covers leftovers in the temp directories, full .enc files in `encrypted/` (only the
+    split parts are needed once an upload finishes), chunk directories without a UserFile row
+    and stray parts inside known chunk directories. The grace period protects uploads and
+    downloads that are still in progress.
+
+    Args:
+        grace_period (int): Minimum age in seconds; defaults to STORAGE_GC_GRACE_PERIOD.
+        dry_run (bool): Only report what would be deleted.
+
+    Returns:
+        list: (path, bytes) for every removed (or, with dry_run, removable) file or directory.
+    """
+    if grace_period is None:
+        grace_period = getattr(settings, 'STORAGE_GC_GRACE_PERIOD', 3600)
+    cutoff = time.time() - grace_period
+    media_root = settings.MEDIA_ROOT
+    removed = []
+
+    # 1. Per-request working files and full encrypted files
+    for dir_name in TEMP_DIRS + ('encrypted',):
+        dir_path = os.path.join(media_root, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        for entry in os.scandir(dir_path):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    size = _tree_stats(entry.path)[0] if entry.is_dir() else entry.stat().st_size
+                    _remove(entry.path, size, dry_run, removed)
+            except FileNotFoundError:
+                continue # Cleaned up by its request in the meantime
+
+    # 2. Chunk directories and parts, compared against all UserFile rows in one query
+    chunks_root = os.path.join(media_root, 'chunks')
+    if os.path.isdir(chunks_root):
+        known_dirs = set()
+        known_parts = set()
+        for encrypted_filename, extra_locations, *locations in UserFile.objects.values_list(
+                'encrypted_filename', 'extra_locations', 'location1', 'location2', 'location3').iterator():
+            known_dirs.add(encrypted_filename.replace('.enc', ''))
+            known_parts.update(os.path.normpath(location) for location in locations + extra_locations if location)
+
+        for entry in os.scandir(chunks_root):
+            try:
+                if not entry.is_dir():
+                    if entry.stat().st_mtime < cutoff:
+                        _remove(entry.path, entry.stat().st_size, dry_run, removed)
+                elif entry.name not in known_dirs:
+                    size, newest = _tree_stats(entry.path)
+                    if newest < cutoff:
+                        _remove(entry.path, size, dry_run, removed)
+                else:
+                    for part in os.scandir(entry.path):
+                        part_rel_path = os.path.normpath(os.path.relpath(part.path, media_root))
+                        if part_rel_path not in known_parts and part.stat().st_mtime < cutoff:
+                            size = _tree_stats(part.path)[0] if part.is_dir() else part.stat().st_size
+                            _remove(part.path, size, dry_run, removed)
+            except FileNotFoundError:
+                continue
+
+    return removed
+
+
+def run_locked(grace_period=None):
+    """Runs collect_orphans unless another process is already collecting; returns the removed list or None."""
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    with open(os.path.join(settings.MEDIA_ROOT, '.janitor.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            return collect_orphans(grace_period)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _scheduler_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            removed = run_locked()
+            if removed:
+                print(f"Janitor: removed {len(removed)} orphan(s), reclaimed {sum(size for _, size in removed)} bytes.")
+        except Exception as e:
+            print(f"Janitor: collection failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def start_scheduler(interval):
+    """Starts a daemon thread that collects orphans every `interval` seconds (once per process)."""
+    global _scheduler_started
+    with _scheduler_lock:
+        if _scheduler_started:
+            return
+        _scheduler_started = True
+    threading.Thread(target=_scheduler_loop, args=(interval,), name='storage-janitor', daemon=True).start()
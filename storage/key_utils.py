@@ -0,0 +1,86 @@
+# storage/key_utils.py
+import hashlib
+import hmac
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import KeyAttempt
+
+VERIFIER_SALT_SIZE = 16 # Maximum salt size of BLAKE2b
+VERIFIER_DIGEST_SIZE = 16
+
+
+def _server_keys():
+    """BLAKE2b keys derived from SECRET_KEY and SECRET_KEY_FALLBACKS, newest first."""
+    secrets = [settings.SECRET_KEY] + list(getattr(settings, 'SECRET_KEY_FALLBACKS', []))
+    return [hashlib.blake2b(secret.encode(), digest_size=32, person=b'key-verifier').digest()
+            for secret in secrets]
+
+
+def _verifier_digest(p, salt, server_key):
+    return hashlib.blake2b(str(p).encode(), key=server_key, salt=salt,
+                           digest_size=VERIFIER_DIGEST_SIZE).hexdigest()
+
+
+def make_key_verifier(p):
+    """
+    Builds the value stored with a file to recognise its user key `p` without decrypting anything.
+
+    It is a salted BLAKE2b MAC of `p` keyed with a key derived from SECRET_KEY, so the database
+    alone is not enough to test candidate keys against it. Format: '<salt hex>$<digest hex>'.
+    """
+    salt = os.urandom(VERIFIER_SALT_SIZE)
+    return f"{salt.hex()}${_verifier_digest(p, salt, _server_keys()[0])}"
+
+
+def check_key(p, key_verifier):
+    """
+    Checks a user key against a stored verifier in constant time.
+
+    Returns:
+        bool: True or False, or None if the file has no (valid) verifier and the key cannot be
+              checked up front.
+    """
+    try:
+        salt_hex, expected = key_verifier.split('$')
+        salt = bytes.fromhex(salt_hex)
+    except ValueError:
+        return None
+    return any(hmac.compare_digest(_verifier_digest(p, salt, server_key), expected)
+               for server_key in _server_keys())
+
+
+# --- Wrong-key rate limiting, counted in the database so every worker process sees the same counts ---
+def _window_start():
+    return timezone.now() - timedelta(seconds=getattr(settings, 'STORAGE_KEY_ATTEMPT_WINDOW', 300))
+
+
+def key_attempts_blocked(username, file_id):
+    """Whether the user has used up their wrong-key attempts for this file in the current window."""
+    limit = getattr(settings, 'STORAGE_KEY_ATTEMPT_LIMIT', 5)
+    return KeyAttempt.objects.filter(username=username, file_id=file_id, count__gte=limit,
+                                     window_start__gte=_window_start()).exists()
+
+
+def record_wrong_key(username, file_id):
+    """
+    Counts a wrong-key attempt; the count expires STORAGE_KEY_ATTEMPT_WINDOW seconds after the first one.
+
+    Also used for every attempt on files without a key verifier, where a wrong key is only
+    noticed after a full decryption.
+    """
+    now = timezone.now()
+    attempt, created = KeyAttempt.objects.get_or_create(username=username, file_id=file_id,
+                                                        defaults={'count': 1, 'window_start': now})
+    if created:
+        return
+    # Start a new window if the last one expired, otherwise count up; each is a single UPDATE
+    attempts = KeyAttempt.objects.filter(pk=attempt.pk)
+    if not attempts.filter(window_start__lt=_window_start()).update(count=1, window_start=now):
+        attempts.update(count=F('count') + 1)
+
+
+def clear_wrong_keys(username, file_id):
+    KeyAttempt.objects.filter(username=username, file_id=file_id).delete()
@@ -0,0 +1,23 @@
+# storage/management/commands/collect_orphans.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from storage.janitor import collect_orphans
+
+
+class Command(BaseCommand):
+    help = "Deletes temp files, encrypted blobs and chunks under MEDIA_ROOT that no UserFile refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-period', type=int,
+                            default=getattr(settings, 'STORAGE_GC_GRACE_PERIOD', 3600),
+                            help="Only delete orphans older than this many seconds.")
+        parser.add_argument('--dry-run', action='store_true', help="List orphans without deleting them.")
+
+    def handle(self, *args, **options):
+        removed = collect_orphans(options['grace_period'], dry_run=options['dry_run'])
+        if options['verbosity'] > 1 or options['dry_run']:
+            for path, size in removed:
+                self.stdout.write(f"{path} ({size} bytes)")
+        action = "Would remove" if options['dry_run'] else "Removed"
+        reclaimed = sum(size for _, size in removed)
+        self.stdout.write(self.style.SUCCESS(f"{action} {len(removed)} orphan(s), {reclaimed} bytes."))
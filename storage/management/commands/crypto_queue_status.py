@@ -0,0 +1,18 @@
+# storage/management/commands/crypto_queue_status.py
+from django.core.management.base import BaseCommand
+from storage.admission import metrics
+
+
+class Command(BaseCommand):
+    help = "Shows running and queued encryption/decryption jobs per lane, with admission counters."
+
+    def handle(self, *args, **options):
+        for lane, stats in metrics().items():
+            self.stdout.write(
+                f"{lane}: running {stats['running']}/{stats['slots']}, "
+                f"queued {stats['queued']}/{stats['queue_size']}, "
+                f"admitted {stats.get('admitted', 0)}, "
+                f"rejected {stats.get('rejected_queue_full', 0)} (queue full) + {stats.get('rejected_timeout', 0)} (timeout), "
+                f"wait avg {stats['wait_seconds_avg']:.3f}s max {stats.get('wait_seconds_max', 0.0):.3f}s, "
+                f"job avg {stats.get('service_seconds_avg', 0.0):.3f}s"
+            )
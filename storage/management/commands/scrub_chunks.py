@@ -0,0 +1,50 @@
+# storage/management/commands/scrub_chunks.py
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from storage.integrity import RateLimiter, hash_file, root_digest
+from storage.models import UserFile
+
+
+class Command(BaseCommand):
+    help = "Verifies the stored chunks of every file against the checksums recorded at upload time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, default=getattr(settings, 'STORAGE_SCRUB_RATE_MB', 20),
+                            help="Maximum read rate in MB/s (0 for unlimited).")
+        parser.add_argument('--username', help="Only scrub the files of this user.")
+
+    def handle(self, *args, **options):
+        rate_limiter = RateLimiter(options['rate'] * 1024 * 1024) if options['rate'] > 0 else None
+        files = UserFile.objects.order_by('id').only(
+            'id', 'username', 'original_filename', 'location1', 'location2', 'location3', 'extra_locations',
+            'chunk_digests', 'ciphertext_digest')
+        if options['username']:
+            files = files.filter(username=options['username'])
+
+        checked = skipped = 0
+        problems = []
+        for file_record in files.iterator():
+            label = f"file {file_record.id} ({file_record.username}/{file_record.original_filename})"
+            if not file_record.chunk_digests:
+                skipped += 1 # Uploaded before checksums were recorded
+                continue
+            if root_digest(file_record.chunk_digests) != file_record.ciphertext_digest:
+                problems.append(f"{label}: chunk digests do not match the recorded ciphertext digest")
+            for part_rel_path, expected in zip(file_record.part_paths, file_record.chunk_digests):
+                part_full_path = os.path.join(settings.MEDIA_ROOT, part_rel_path)
+                try:
+                    actual = hash_file(part_full_path, rate_limiter)
+                except FileNotFoundError:
+                    problems.append(f"{label}: missing chunk {part_rel_path}")
+                    continue
+                if actual != expected:
+                    problems.append(f"{label}: checksum mismatch in {part_rel_path}")
+            checked += 1
+
+        for problem in problems:
+            self.stderr.write(problem)
+        summary = f"Scrubbed {checked} file(s), skipped {skipped} without checksums, found {len(problems)} problem(s)."
+        if problems:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-19 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='chunk_digests',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='ciphertext_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='plaintext_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
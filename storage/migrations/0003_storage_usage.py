@@ -0,0 +1,65 @@
+# Generated by Django 5.2 on 2026-10-19 15:26
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_sizes(apps, schema_editor):
+    """One-time stat of the existing parts; afterwards sizes are recorded at upload time."""
+    UserFile = apps.get_model('storage', 'UserFile')
+    StorageUsage = apps.get_model('storage', 'StorageUsage')
+    totals = {}
+    for user_file in UserFile.objects.all():
+        stored_size = 0
+        for location in (user_file.location1, user_file.location2, user_file.location3):
+            if location and os.path.exists(os.path.join(settings.MEDIA_ROOT, location)):
+                stored_size += os.path.getsize(os.path.join(settings.MEDIA_ROOT, location))
+        user_file.stored_size = user_file.ciphertext_size = stored_size
+        user_file.plaintext_size = stored_size // 32 # 32 ciphertext bytes per plaintext byte
+        user_file.save(update_fields=['plaintext_size', 'ciphertext_size', 'stored_size'])
+        usage = totals.setdefault(user_file.username, StorageUsage(username=user_file.username))
+        usage.file_count += 1
+        usage.plaintext_bytes += user_file.plaintext_size
+        usage.ciphertext_bytes += user_file.ciphertext_size
+        usage.stored_bytes += user_file.stored_size
+    StorageUsage.objects.bulk_create(totals.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0002_userfile_digests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150, unique=True)),
+                ('file_count', models.PositiveIntegerField(default=0)),
+                ('plaintext_bytes', models.BigIntegerField(default=0)),
+                ('ciphertext_bytes', models.BigIntegerField(default=0)),
+                ('stored_bytes', models.BigIntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='ciphertext_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='plaintext_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='stored_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_sizes, migrations.RunPython.noop),
+    ]
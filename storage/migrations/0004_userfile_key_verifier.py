@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0003_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='key_verifier',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-19 15:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0004_userfile_key_verifier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeyAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('window_start', models.DateTimeField()),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='key_attempts', to='storage.userfile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('username', 'file'), name='unique_key_attempt_per_user_file')],
+            },
+        ),
+    ]
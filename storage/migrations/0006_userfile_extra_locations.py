@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0005_key_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='extra_locations',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='plaintext_segments',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,5 +1,7 @@
 # storage/models.py
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Q
 import os
 import uuid
 
@@ -10,11 +12,107 @@ class UserFile(models.Model):
     # Store the part of the key needed for decryption (e.g., prime q or the modulus n)
     # The user will provide the other part (e.g., prime p)
     stored_key_part = models.TextField() # Store prime 'q' or modulus 'n'
+    key_verifier = models.CharField(max_length=128, blank=True, default='') # Checks 'p' without decrypting, see key_utils
     # Store relative paths within MEDIA_ROOT
     location1 = models.CharField(max_length=512)
     location2 = models.CharField(max_length=512)
     location3 = models.CharField(max_length=512)
+    extra_locations = models.JSONField(default=list, blank=True) # Parts added by appends, in order
     upload_date = models.DateTimeField(auto_now_add=True)
+    # BLAKE2b hex digests recorded at upload time (empty for files uploaded before checksums existed)
+    plaintext_digest = models.CharField(max_length=64, blank=True, default='') # Of the uploaded bytes, without appends
+    plaintext_segments = models.JSONField(default=list, blank=True) # [size, digest] per appended part, in line with extra_locations
+    chunk_digests = models.JSONField(default=list, blank=True) # One digest per stored part, in order
+    ciphertext_digest = models.CharField(max_length=64, blank=True, default='') # Root over chunk_digests
+    # Sizes in bytes, recorded at upload time so listings and quotas never stat the filesystem
+    plaintext_size = models.BigIntegerField(default=0)
+    ciphertext_size = models.BigIntegerField(default=0)
+    stored_size = models.BigIntegerField(default=0) # Sum of the stored parts
+
+    @property
+    def part_paths(self):
+        """Relative paths of the stored parts, in order, skipping parts that were not needed."""
+        return [path for path in (self.location1, self.location2, self.location3) if path] + list(self.extra_locations)
+
+    @property
+    def plaintext_checks(self):
+        """(size, digest) of each plaintext segment in order, or None if the plaintext cannot be verified."""
+        if not self.plaintext_digest or len(self.plaintext_segments) != len(self.extra_locations):
+            return None
+        appended_size = sum(size for size, _ in self.plaintext_segments)
+        return [(self.plaintext_size - appended_size, self.plaintext_digest)] + [
+            (size, digest) for size, digest in self.plaintext_segments]
+
+    def __str__(self):
+        return f"{self.username} - {self.original_filename}"
+
+
+class StorageUsage(models.Model):
+    """Per-user storage totals, updated incrementally whenever a file is added or deleted."""
+    username = models.CharField(max_length=150, unique=True)
+    file_count = models.PositiveIntegerField(default=0)
+    plaintext_bytes = models.BigIntegerField(default=0)
+    ciphertext_bytes = models.BigIntegerField(default=0)
+    stored_bytes = models.BigIntegerField(default=0)
+    quota_bytes = models.BigIntegerField(null=True, blank=True) # Overrides STORAGE_QUOTA_BYTES when set
+
+    @staticmethod
+    def quota_for(usage):
+        """Effective quota in stored bytes for a usage row (or None for a new user); None means unlimited."""
+        if usage is not None and usage.quota_bytes is not None:
+            return usage.quota_bytes
+        return getattr(settings, 'STORAGE_QUOTA_BYTES', None)
+
+    @classmethod
+    def reserve(cls, username, stored_bytes):
+        """
+        Atomically adds `stored_bytes` to the user's stored total if it stays within their quota.
+
+        The quota check and the increment are a single conditional UPDATE, so concurrent
+        uploads cannot together overshoot the quota. Returns whether the bytes were reserved;
+        give them back with release() if the work they were reserved for fails.
+        """
+        cls.objects.get_or_create(username=username)
+        within_quota = Q(quota_bytes__isnull=False, stored_bytes__lte=F('quota_bytes') - stored_bytes)
+        default_quota = getattr(settings, 'STORAGE_QUOTA_BYTES', None)
+        if default_quota is None:
+            within_quota |= Q(quota_bytes__isnull=True)
+        else:
+            within_quota |= Q(quota_bytes__isnull=True, stored_bytes__lte=default_quota - stored_bytes)
+        return cls.objects.filter(within_quota, username=username).update(
+            stored_bytes=F('stored_bytes') + stored_bytes) == 1
+
+    @classmethod
+    def release(cls, username, stored_bytes):
+        """Gives back bytes taken with reserve() that were not used."""
+        cls.objects.filter(username=username).update(stored_bytes=F('stored_bytes') - stored_bytes)
+
+    @classmethod
+    def record(cls, username, files=0, plaintext_bytes=0, ciphertext_bytes=0, stored_bytes=0):
+        """Adds (or, with negative values, subtracts) to the user's totals with a single UPDATE."""
+        cls.objects.get_or_create(username=username)
+        cls.objects.filter(username=username).update(
+            file_count=F('file_count') + files,
+            plaintext_bytes=F('plaintext_bytes') + plaintext_bytes,
+            ciphertext_bytes=F('ciphertext_bytes') + ciphertext_bytes,
+            stored_bytes=F('stored_bytes') + stored_bytes,
+        )
+
+    def __str__(self):
+        return f"{self.username} - {self.stored_bytes} bytes in {self.file_count} files"
+
+
+class KeyAttempt(models.Model):
+    """Wrong file keys entered for a file in the current window, shared by all worker processes."""
+    username = models.CharField(max_length=150)
+    file = models.ForeignKey(UserFile, on_delete=models.CASCADE, related_name='key_attempts')
+    count = models.PositiveIntegerField(default=0)
+    window_start = models.DateTimeField() # Time of the first wrong key in the window
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['username', 'file'], name='unique_key_attempt_per_user_file'),
+        ]
 
     def __str__(self):
-        return f"{self.username} - {self.original_filename}"
\ No newline at end of file
+        return f"{self.username} - file {self.file_id}: {self.count} wrong key(s)"
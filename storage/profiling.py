@@ -0,0 +1,128 @@
+# storage/profiling.py
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from django.conf import settings
+
+
+# tracemalloc is process-wide, so only one request at a time may trace allocations
+_tracemalloc_lock = threading.Lock()
+
+
+def tag_file_size(request, size):
+    """Lets a view report the size of the file it works on, used to tag its profiling reports."""
+    request.profiled_file_size = size
+
+
+def _profiling_modes():
+    """Returns (use_cprofile, use_tracemalloc) for this request, or None to skip profiling."""
+    enabled = getattr(settings, 'STORAGE_PROFILING_ENABLED', False)
+    sample_rate = getattr(settings, 'STORAGE_PROFILING_SAMPLE_RATE', 0.0)
+    if not enabled and not (sample_rate and random.random() < sample_rate):
+        return None
+    use_cprofile = getattr(settings, 'STORAGE_PROFILING_CPROFILE', True)
+    use_tracemalloc = getattr(settings, 'STORAGE_PROFILING_TRACEMALLOC', True)
+    if not (use_cprofile or use_tracemalloc):
+        return None
+    return use_cprofile, use_tracemalloc
+
+
+def _request_size(request):
+    """Size in bytes of the file the view tagged, else of the uploaded files, else of the request body."""
+    if getattr(request, 'profiled_file_size', None) is not None:
+        return request.profiled_file_size
+    total = sum(f.size for f in request.FILES.values())
+    if total:
+        return total
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _write_allocation_report(snapshot, report_path, header):
+    """Writes the top allocation sites of a tracemalloc snapshot to a text file."""
+    top_n = getattr(settings, 'STORAGE_PROFILING_TOP_ALLOCATIONS', 25)
+    stats = snapshot.statistics('lineno')
+    with open(report_path, 'w') as report:
+        report.write(header + '\n')
+        report.write(f"Total traced: {sum(stat.size for stat in stats)} bytes\n\n")
+        for stat in stats[:top_n]:
+            report.write(f"{stat}\n")
+
+
+def profile_view(view_func):
+    """
+    Runs the wrapped view under cProfile and/or tracemalloc when profiling is enabled.
+
+    Profiling is switched on for every request with STORAGE_PROFILING_ENABLED, or for a
+    random fraction of requests with STORAGE_PROFILING_SAMPLE_RATE. Reports are written to
+    STORAGE_PROFILING_DIR as '<view>_<request id>_<size>b.prof' (load with pstats or
+    snakeviz) and '<view>_<request id>_<size>b.alloc.txt'. When disabled, the only cost is
+    a couple of settings lookups per request.
+    """
+    @functools.wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        modes = _profiling_modes()
+        if modes is None:
+            return view_func(request, *args, **kwargs)
+        use_cprofile, use_tracemalloc = modes
+
+        profiler = None
+        if use_cprofile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError: # Another profiler is already active (e.g. a concurrent request)
+                print(f"Profiling: cProfile busy, skipping it for {view_func.__name__}.")
+                profiler = None
+
+        started_tracemalloc = False
+        if use_tracemalloc:
+            if _tracemalloc_lock.acquire(blocking=False):
+                if not tracemalloc.is_tracing(): # May already be on, e.g. with python -X tracemalloc
+                    tracemalloc.start(getattr(settings, 'STORAGE_PROFILING_TRACEMALLOC_FRAMES', 1))
+                    started_tracemalloc = True
+                tracemalloc.clear_traces() # Only this request's allocations
+            else:
+                print(f"Profiling: tracemalloc busy with another request, skipping it for {view_func.__name__}.")
+                use_tracemalloc = False
+
+        start = time.perf_counter()
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            snapshot = None
+            if use_tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracemalloc:
+                    tracemalloc.stop()
+                _tracemalloc_lock.release()
+
+            try:
+                output_dir = getattr(settings, 'STORAGE_PROFILING_DIR',
+                                     os.path.join(settings.BASE_DIR, 'profiles'))
+                os.makedirs(output_dir, exist_ok=True)
+                request_id = request.META.get('HTTP_X_REQUEST_ID', '')
+                request_id = ''.join(c for c in request_id if c.isalnum() or c in '-_')[:64] or uuid.uuid4().hex
+                size = _request_size(request)
+                report_base = os.path.join(output_dir, f"{view_func.__name__}_{request_id}_{size}b")
+                header = (f"{request.method} {request.path} view={view_func.__name__} "
+                          f"request_id={request_id} size={size} elapsed={elapsed:.3f}s")
+                if profiler is not None:
+                    profiler.dump_stats(f"{report_base}.prof")
+                if snapshot is not None:
+                    _write_allocation_report(snapshot, f"{report_base}.alloc.txt", header)
+                print(f"Profiling: {header} -> {report_base}.*")
+            except OSError as e:
+                print(f"Profiling: could not write reports for {view_func.__name__}: {e}")
+
+    return wrapper
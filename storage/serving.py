@@ -0,0 +1,115 @@
+# storage/serving.py
+import os
+import time
+import uuid
+from django.conf import settings
+from django.core import signing
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.http import content_disposition_header
+
+TOKEN_SALT = 'storage.serving'
+SERVED_DIR = 'served' # Under MEDIA_ROOT; files are moved here when their token is used
+DECRYPTED_DIR = 'temp_decrypted' # Under MEDIA_ROOT; decrypted files wait here for their token
+
+
+def _max_age():
+    return getattr(settings, 'STORAGE_SERVE_TOKEN_MAX_AGE', 60)
+
+
+def sweep_expired():
+    """
+    Removes decrypted plaintext whose token can no longer be used.
+
+    Unclaimed files in DECRYPTED_DIR are aged from when their token was issued and served
+    files from when they were claimed, so anything older than STORAGE_SERVE_TOKEN_MAX_AGE is
+    either expired or has long been handed to the front-end server. Called on every issue
+    and claim, so plaintext does not outlive its link by much even without the orphan collector.
+    """
+    cutoff = time.time() - _max_age()
+    for dir_name in (DECRYPTED_DIR, SERVED_DIR):
+        try:
+            entries = list(os.scandir(os.path.join(settings.MEDIA_ROOT, dir_name)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue # Claimed or swept by another request in the meantime
+
+
+def issue_token(materialized_path, download_filename, username):
+    """
+    Returns a signed, expiring token that lets `username` fetch a materialized output once.
+
+    Args:
+        materialized_path (str): Absolute path of the decrypted file, inside MEDIA_ROOT.
+        download_filename (str): Filename to present to the browser.
+        username (str): Session user the token is bound to.
+    """
+    os.utime(materialized_path) # The file is swept once this token has expired
+    sweep_expired()
+    return signing.dumps({
+        'path': os.path.relpath(materialized_path, settings.MEDIA_ROOT),
+        'name': download_filename,
+        'user': username,
+    }, salt=TOKEN_SALT, compress=True)
+
+
+def claim(token, username):
+    """
+    Validates a token and claims its file, so that no other request can use the same token.
+
+    The claim is an os.rename into SERVED_DIR, which succeeds for exactly one request even
+    across worker processes.
+
+    Returns:
+        tuple: (served file path, download filename)
+    """
+    sweep_expired()
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=_max_age())
+    except signing.BadSignature: # Includes SignatureExpired
+        raise Http404("Download link is invalid or has expired.")
+    if payload.get('user') != username:
+        raise Http404("Download link is invalid or has expired.")
+
+    source_path = os.path.join(settings.MEDIA_ROOT, payload['path'])
+    served_dir = os.path.join(settings.MEDIA_ROOT, SERVED_DIR)
+    os.makedirs(served_dir, exist_ok=True)
+    served_path = os.path.join(served_dir, f"{uuid.uuid4().hex}{os.path.splitext(source_path)[1]}")
+    try:
+        os.rename(source_path, served_path)
+    except FileNotFoundError:
+        raise Http404("Download link has already been used.")
+    os.utime(served_path) # Age served files from the claim, not from decryption
+    return served_path, payload['name']
+
+
+def serve_file(served_path, download_filename, content_type='text/plain'):
+    """
+    Builds the response for a claimed file using the configured STORAGE_SERVE_BACKEND.
+
+    'nginx' returns an X-Accel-Redirect to STORAGE_SERVE_INTERNAL_URL and 'sendfile' an
+    X-Sendfile header (Apache mod_xsendfile, lighttpd), so the front-end server streams the
+    bytes; the file is removed by sweep_expired() once it is STORAGE_SERVE_TOKEN_MAX_AGE
+    seconds past its claim (the front-end keeps reading a file it has open). 'django' (the
+    default) streams it with FileResponse, which WSGI servers such as Gunicorn send with
+    sendfile(); the file is unlinked as soon as it is open.
+    """
+    backend = getattr(settings, 'STORAGE_SERVE_BACKEND', 'django')
+    if backend in ('nginx', 'sendfile'):
+        response = HttpResponse(content_type=content_type)
+        response['Content-Disposition'] = content_disposition_header(True, download_filename)
+        if backend == 'nginx':
+            internal_url = getattr(settings, 'STORAGE_SERVE_INTERNAL_URL', '/protected/')
+            relative_url = os.path.relpath(served_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            response['X-Accel-Redirect'] = internal_url.rstrip('/') + '/' + relative_url
+        else:
+            response['X-Sendfile'] = served_path
+        return response
+
+    served_file = open(served_path, 'rb')
+    os.remove(served_path) # The open handle keeps the data readable until the response is closed
+    return FileResponse(served_file, as_attachment=True, filename=download_filename, content_type=content_type)
@@ -1,3 +1,451 @@
-from django.test import TestCase
+import contextlib
+import errno
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .admission import NAMED_LOCK_BUCKETS, AdmissionRejected, admit, exclusive, metrics
+from .encryption_utils import split_file
+from .io_utils import copy_range, iter_blocks
+from .janitor import collect_orphans
+from .models import KeyAttempt, StorageUsage, UserFile
+
+
+class StorageTestCase(TestCase):
+    """Runs every test against its own MEDIA_ROOT and admission lock directory."""
+
+    username = 'alice'
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.work_dir, 'media'),
+            STORAGE_CRYPTO_LOCK_DIR=os.path.join(self.work_dir, 'run'),
+            ALLOWED_HOSTS=['testserver'],
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        session = self.client.session
+        session['username'] = self.username
+        session.save()
+
+    def upload(self, content, name='notes.txt'):
+        """Uploads `content` and returns (UserFile, key p)."""
+        response = self.client.post(reverse('storage:upload_page'), {
+            'file': SimpleUploadedFile(name, content, content_type='text/plain'),
+        })
+        self.assertEqual(response.status_code, 200)
+        key = response.context['file_key_p']
+        self.assertTrue(key)
+        return UserFile.objects.filter(username=self.username).latest('id'), key
+
+    def download(self, file_record, key):
+        """Posts the download form and follows the token redirect; returns the final response."""
+        response = self.client.post(reverse('storage:download_file'), {
+            'file_id': file_record.id,
+            'file_key': str(key),
+        })
+        if response.status_code == 302 and '/serve/' in response['Location']:
+            return self.client.get(response['Location'])
+        return response
+
+    def error_messages(self, response):
+        return [str(message) for message in response.context['messages']] if response.context else []
+
+
+class ProfilingTests(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(STORAGE_PROFILING_ENABLED=True, STORAGE_PROFILING_TOP_ALLOCATIONS=5,
+                                              STORAGE_PROFILING_DIR=os.path.join(self.work_dir, 'profiles'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def reports(self):
+        return sorted(os.listdir(os.path.join(self.work_dir, 'profiles')))
+
+    def test_reports_are_tagged_with_request_id_and_file_size(self):
+        response = self.client.post(reverse('storage:upload_page'), {
+            'file': SimpleUploadedFile('notes.txt', b'12345', content_type='text/plain'),
+        }, HTTP_X_REQUEST_ID='req-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.reports(), ['upload_page_view_req-1_5b.alloc.txt', 'upload_page_view_req-1_5b.prof'])
+        with open(os.path.join(self.work_dir, 'profiles', 'upload_page_view_req-1_5b.alloc.txt')) as report:
+            self.assertIn('request_id=req-1 size=5', report.readline())
+
+    def test_delete_is_tagged_with_the_stored_file_size(self):
+        file_record, _ = self.upload(b'1234567')
+        self.client.post(reverse('storage:delete_file', args=[file_record.id]), HTTP_X_REQUEST_ID='req-2')
+        self.assertIn('delete_file_view_req-2_7b.prof', self.reports())
+
+    @override_settings(STORAGE_PROFILING_ENABLED=False, STORAGE_PROFILING_SAMPLE_RATE=0.0)
+    def test_disabled_profiling_writes_nothing(self):
+        self.upload(b'abc')
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'profiles')))
+
+
+class RoundTripTests(StorageTestCase):
+
+    def test_upload_then_download(self):
+        file_record, key = self.upload(b'hello, world\n' * 100)
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'hello, world\n' * 100)
+
+    def test_corrupted_part_is_rejected(self):
+        file_record, key = self.upload(b'hello, world\n')
+        part_path = os.path.join(self.work_dir, 'media', file_record.location2)
+        with open(part_path, 'r+b') as part:
+            first = part.read(1)
+            part.seek(0)
+            part.write(b'1' if first == b'0' else b'0') # Flip one ciphertext bit
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('This file is corrupted (checksum mismatch). Download aborted.', self.error_messages(response))
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'media', 'temp_combined')))
+
+    def test_wrong_plaintext_digest_fails_download(self):
+        file_record, key = self.upload(b'hello, world\n')
+        UserFile.objects.filter(id=file_record.id).update(plaintext_digest='0' * 64)
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('The decrypted file does not match its checksum. Download aborted.',
+                      self.error_messages(response))
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'media', 'temp_decrypted')), [])
+
+    def test_failed_split_leaves_nothing_behind(self):
+        with mock.patch('storage.encryption_utils.copy_range', side_effect=OSError(errno.EIO, 'I/O error')):
+            response = self.client.post(reverse('storage:upload_page'), {
+                'file': SimpleUploadedFile('a.txt', b'plaintext\n', content_type='text/plain'),
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Error storing the encrypted file. Please try again.', response.context['form'].non_field_errors())
+        self.assertFalse(UserFile.objects.exists())
+        media = os.path.join(self.work_dir, 'media')
+        self.assertFalse(os.path.exists(os.path.join(media, 'temp')))
+        self.assertEqual(os.listdir(os.path.join(media, 'encrypted')), [])
+        self.assertEqual(os.listdir(os.path.join(media, 'chunks')), [])
+
+
+class CopyRangeTests(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.source_path = os.path.join(self.work_dir, 'source')
+        with open(self.source_path, 'wb') as source:
+            source.write(bytes(range(256)) * 64)
+
+    def copy(self, offset, count):
+        with open(self.source_path, 'rb') as source, open(os.path.join(self.work_dir, 'copy'), 'w+b') as copy:
+            copied = copy_range(source.fileno(), copy.fileno(), offset, count)
+            copy.seek(0)
+            return copied, copy.read()
+
+    def expected(self, offset, count):
+        with open(self.source_path, 'rb') as source:
+            source.seek(offset)
+            return source.read(count)
+
+    def test_copy_file_range(self):
+        self.assertEqual(self.copy(100, 5000), (5000, self.expected(100, 5000)))
+
+    def test_falls_back_to_sendfile(self):
+        with mock.patch('storage.io_utils.os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross-device'), create=True):
+            self.assertEqual(self.copy(100, 5000), (5000, self.expected(100, 5000)))
+
+    def test_falls_back_to_mmap_writes(self):
+        with mock.patch('storage.io_utils.os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross-device'), create=True), \
+                mock.patch('storage.io_utils.os.sendfile', side_effect=OSError(errno.EINVAL, 'unsupported'), create=True):
+            self.assertEqual(self.copy(100, 5000), (5000, self.expected(100, 5000)))
+            self.assertEqual(self.copy(16000, 1000), (384, self.expected(16000, 384))) # Source ends early
+
+    def test_iter_blocks(self):
+        with open(self.source_path, 'rb') as source:
+            blocks = list(iter_blocks(source, 5000))
+        self.assertEqual([len(block) for block in blocks], [5000, 5000, 5000, 1384])
+        self.assertEqual(b''.join(blocks), self.expected(0, 16384))
+        empty_path = os.path.join(self.work_dir, 'empty')
+        open(empty_path, 'wb').close()
+        with open(empty_path, 'rb') as empty:
+            self.assertEqual(list(iter_blocks(empty, 32)), [])
+
+    @override_settings()
+    def test_short_copy_fails_the_split(self):
+        settings.MEDIA_ROOT = self.work_dir
+        with mock.patch('storage.encryption_utils.copy_range', return_value=10):
+            self.assertIsNone(split_file(self.source_path)[0])
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'chunks', 'source')))
+
+
+class OrphanTests(StorageTestCase):
+
+    def make(self, *parts, age=7200, content=b'x' * 10):
+        path = os.path.join(self.work_dir, 'media', *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+        os.utime(os.path.dirname(path), (stamp, stamp))
+        return path
+
+    def test_collects_only_old_unreferenced_files(self):
+        file_record, _ = self.upload(b'kept\n')
+        media = os.path.join(self.work_dir, 'media')
+        known_parts = [os.path.join(media, path) for path in file_record.part_paths]
+        for part in known_parts:
+            stamp = time.time() - 7200
+            os.utime(part, (stamp, stamp))
+        known_dir = os.path.dirname(known_parts[0])
+
+        old_temp = self.make('temp', 'crashed.txt')
+        new_temp = self.make('temp', 'in_progress.txt', age=10)
+        old_blob = self.make('encrypted', 'alice_dead.enc')
+        stray_part = self.make('chunks', os.path.basename(known_dir), 'part_9')
+        unknown_dir = os.path.dirname(self.make('chunks', 'alice_gone', 'part_1'))
+        new_unknown_dir = os.path.dirname(self.make('chunks', 'alice_uploading', 'part_1', age=10))
+
+        removed = dict(collect_orphans(grace_period=3600, dry_run=True))
+        self.assertEqual(set(removed), {old_temp, old_blob, stray_part, unknown_dir})
+        self.assertEqual(removed[unknown_dir], 10)
+        self.assertTrue(all(os.path.exists(path) for path in removed)) # Dry run deletes nothing
+
+        output = StringIO()
+        call_command('collect_orphans', '--grace-period', '3600', stdout=output)
+        self.assertIn('Removed 4 orphan(s), 40 bytes.', output.getvalue())
+        self.assertFalse(any(os.path.exists(path) for path in removed))
+        for path in known_parts + [new_temp, new_unknown_dir]:
+            self.assertTrue(os.path.exists(path))
+
+        response = self.download(file_record, _)
+        self.assertEqual(b''.join(response.streaming_content), b'kept\n')
+
+    def test_dry_run_command_lists_orphans(self):
+        orphan = self.make('temp_decrypted', 'left.tmp')
+        output = StringIO()
+        call_command('collect_orphans', '--dry-run', stdout=output)
+        self.assertIn(f"{orphan} (10 bytes)", output.getvalue())
+        self.assertIn('Would remove 1 orphan(s), 10 bytes.', output.getvalue())
+        self.assertTrue(os.path.exists(orphan))
+
+
+class QuotaTests(StorageTestCase):
+
+    @override_settings(STORAGE_QUOTA_BYTES=100 * 32)
+    def test_upload_over_quota_is_rejected(self):
+        response = self.client.post(reverse('storage:upload_page'), {
+            'file': SimpleUploadedFile('big.txt', b'x' * 101, content_type='text/plain'),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Not enough storage space left for this file.", response.context['form'].errors['file'])
+        self.assertFalse(UserFile.objects.exists())
+        self.assertEqual(StorageUsage.objects.get(username=self.username).stored_bytes, 0)
+
+    @override_settings(STORAGE_QUOTA_BYTES=100)
+    def test_reservations_cannot_overshoot_quota(self):
+        self.assertTrue(StorageUsage.reserve(self.username, 60))
+        self.assertFalse(StorageUsage.reserve(self.username, 60))
+        StorageUsage.release(self.username, 60)
+        self.assertTrue(StorageUsage.reserve(self.username, 100))
+        StorageUsage.objects.filter(username=self.username).update(quota_bytes=150)
+        self.assertTrue(StorageUsage.reserve(self.username, 50))
+        self.assertFalse(StorageUsage.reserve(self.username, 1))
+
+    def test_upload_records_usage(self):
+        file_record, _ = self.upload(b'abc')
+        usage = StorageUsage.objects.get(username=self.username)
+        self.assertEqual((usage.file_count, usage.plaintext_bytes, usage.stored_bytes), (1, 3, file_record.stored_size))
+
+
+class WrongKeyTests(StorageTestCase):
+
+    def test_wrong_key_is_rejected_before_decryption(self):
+        file_record, key = self.upload(b'secret\n')
+        response = self.download(file_record, key + 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Incorrect file key.', self.error_messages(response))
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'media', 'temp_combined')))
+
+    @override_settings(STORAGE_KEY_ATTEMPT_LIMIT=2, STORAGE_KEY_ATTEMPT_WINDOW=300)
+    def test_lockout_after_too_many_wrong_keys(self):
+        file_record, key = self.upload(b'secret\n')
+        for _ in range(2):
+            self.assertEqual(self.download(file_record, key + 2).status_code, 200)
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '300')
+
+    @override_settings(STORAGE_KEY_ATTEMPT_LIMIT=2, STORAGE_KEY_ATTEMPT_WINDOW=300)
+    def test_lockout_expires_with_the_window(self):
+        file_record, key = self.upload(b'secret\n')
+        for _ in range(2):
+            self.download(file_record, key + 2)
+        KeyAttempt.objects.update(window_start=timezone.now() - timedelta(seconds=301))
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'secret\n')
+        self.assertFalse(KeyAttempt.objects.exists())
+
+    @override_settings(STORAGE_KEY_ATTEMPT_LIMIT=2)
+    def test_every_attempt_counts_for_files_without_a_verifier(self):
+        file_record, key = self.upload(b'secret\n')
+        UserFile.objects.filter(id=file_record.id).update(key_verifier='')
+        for _ in range(2):
+            response = self.download(file_record, key)
+            self.assertEqual(b''.join(response.streaming_content), b'secret\n')
+        self.assertEqual(self.download(file_record, key).status_code, 429)
+
+
+@override_settings(STORAGE_SERVE_BACKEND='nginx', STORAGE_SERVE_TOKEN_MAX_AGE=60)
+class ServingTests(StorageTestCase):
+
+    def age(self, dir_name, seconds):
+        directory = os.path.join(self.work_dir, 'media', dir_name)
+        for name in os.listdir(directory):
+            stamp = time.time() - seconds
+            os.utime(os.path.join(directory, name), (stamp, stamp))
+
+    def test_proxy_backends_do_not_leave_plaintext_behind(self):
+        file_record, key = self.upload(b'served\n')
+        response = self.download(file_record, key)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected/served/'))
+        served_dir = os.path.join(self.work_dir, 'media', 'served')
+        self.assertEqual(len(os.listdir(served_dir)), 1)
+
+        # An unclaimed download, then both files outlive the token lifetime
+        unclaimed = self.client.post(reverse('storage:download_file'), {'file_id': file_record.id, 'file_key': str(key)})
+        self.assertEqual(unclaimed.status_code, 302)
+        self.age('served', 61)
+        self.age('temp_decrypted', 61)
+
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(os.listdir(served_dir)), 1) # Only the file just claimed
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'media', 'temp_decrypted')), [])
+        self.assertEqual(self.client.get(unclaimed['Location']).status_code, 404)
+
+
+@override_settings(STORAGE_CRYPTO_SLOTS=1, STORAGE_CRYPTO_USER_SLOTS=1, STORAGE_CRYPTO_QUEUE_SIZE=4,
+                   STORAGE_CRYPTO_QUEUE_TIMEOUT=0.05)
+class AdmissionTests(StorageTestCase):
+
+    def post_upload(self):
+        return self.client.post(reverse('storage:upload_page'), {
+            'file': SimpleUploadedFile('busy.txt', b'busy\n', content_type='text/plain'),
+        })
+
+    def test_upload_gets_429_while_lane_is_busy(self):
+        with admit('bob', 1):
+            self.assertEqual(metrics()['small']['running'], 1)
+            response = self.post_upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertFalse(UserFile.objects.exists())
+        self.assertEqual(StorageUsage.objects.get(username=self.username).stored_bytes, 0)
+        snapshot = metrics()['small']
+        self.assertEqual((snapshot['running'], snapshot['queued']), (0, 0))
+        self.assertEqual(snapshot['rejected_timeout'], 1)
+
+    @override_settings(STORAGE_CRYPTO_QUEUE_SIZE=0)
+    def test_full_queue_is_rejected_at_once(self):
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with admit(self.username, 1):
+                pass
+        self.assertEqual(rejected.exception.reason, 'queue full')
+        self.assertEqual(self.post_upload().status_code, 429)
+
+    def test_named_locks_use_a_fixed_set_of_files(self):
+        for i in range(NAMED_LOCK_BUCKETS * 2):
+            with exclusive(f"append_{i}"):
+                pass
+        self.assertLessEqual(len(os.listdir(os.path.join(self.work_dir, 'run', 'named'))), NAMED_LOCK_BUCKETS)
+
+    def test_upload_runs_once_the_lane_is_free(self):
+        with admit('bob', 1):
+            pass
+        self.assertEqual(self.post_upload().status_code, 200)
+        self.assertEqual(metrics()['small']['completed'], 2)
+
+
+class AppendTests(StorageTestCase):
+
+    def append(self, file_record, key, content, name='more.txt'):
+        return self.client.post(reverse('storage:append_file', args=[file_record.id]), {
+            'file_key': str(key),
+            'file': SimpleUploadedFile(name, content, content_type='text/plain'),
+        })
+
+    def test_append_then_download(self):
+        file_record, key = self.upload(b'first line\n')
+        self.assertEqual(self.append(file_record, key, b'second line\n').status_code, 302)
+        self.assertEqual(self.append(file_record, key, b'third\n').status_code, 302)
+        file_record.refresh_from_db()
+        self.assertEqual(len(file_record.extra_locations), 2)
+        self.assertEqual([size for size, _ in file_record.plaintext_checks], [11, 12, 6])
+
+        response = self.download(file_record, key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'first line\nsecond line\nthird\n')
+        usage = StorageUsage.objects.get(username=self.username)
+        self.assertEqual((usage.plaintext_bytes, usage.stored_bytes), (29, file_record.stored_size))
+
+    def test_tampered_appended_segment_fails_download(self):
+        file_record, key = self.upload(b'first line\n')
+        self.append(file_record, key, b'second line\n')
+        file_record.refresh_from_db()
+        UserFile.objects.filter(id=file_record.id).update(plaintext_segments=[[12, '0' * 64]])
+        response = self.download(file_record, key)
+        self.assertIn('The decrypted file does not match its checksum. Download aborted.',
+                      self.error_messages(response))
+
+    def test_append_to_a_file_deleted_meanwhile(self):
+        file_record, key = self.upload(b'first line\n')
+        self.assertEqual(self.client.post(reverse('storage:delete_file', args=[file_record.id])).status_code, 302)
+        self.assertEqual(self.append(file_record, key, b'late\n').status_code, 404)
+        self.assertEqual(StorageUsage.objects.get(username=self.username).stored_bytes, 0)
+
+    def test_append_waiting_for_a_delete(self):
+        file_record, key = self.upload(b'first line\n')
+
+        @contextlib.contextmanager
+        def deleted_while_waiting(name):
+            UserFile.objects.filter(id=file_record.id).delete() # The delete that held the lock
+            yield
+
+        with mock.patch('storage.views.exclusive', deleted_while_waiting):
+            response = self.append(file_record, key, b'late\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("'notes.txt' was deleted. Nothing was appended.", self.error_messages(response))
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, 'media', 'temp')), [])
+
+    def test_append_overwrites_part_left_by_a_crashed_append(self):
+        file_record, key = self.upload(b'first line\n')
+        chunk_dir = os.path.dirname(os.path.join(self.work_dir, 'media', file_record.location1))
+        stale_part = os.path.join(chunk_dir, f"part_{len(file_record.part_paths) + 1}")
+        with open(stale_part, 'w') as f:
+            f.write('garbage from an append that never got recorded')
+        self.assertEqual(self.append(file_record, key, b'second line\n').status_code, 302)
+        response = self.download(file_record, key)
+        self.assertEqual(b''.join(response.streaming_content), b'first line\nsecond line\n')
+
+    def test_append_requires_a_txt_file(self):
+        file_record, key = self.upload(b'first line\n')
+        response = self.append(file_record, key, b'MZ', name='tool.exe')
+        self.assertIn('Invalid append request: Invalid file type. Only .txt files are allowed.',
+                      self.error_messages(response))
+        file_record.refresh_from_db()
+        self.assertEqual(file_record.extra_locations, [])
@@ -9,6 +9,8 @@ urlpatterns = [
     path('upload/', views.upload_page_view, name='upload_page'),
     path('download/', views.download_list_view, name='download_list'),
     path('download/file/', views.download_file_view, name='download_file'),
+    path('download/serve/<str:token>/', views.serve_download_view, name='serve_download'),
     # Add this line for the delete action
     path('delete/<int:file_id>/', views.delete_file_view, name='delete_file'),
+    path('append/<int:file_id>/', views.append_file_view, name='append_file'),
 ]
\ No newline at end of file
@@ -1,13 +1,18 @@
 # storage/views.py
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, Http404
+from django.http import Http404
 from django.conf import settings
-from .models import UserFile
+from .models import StorageUsage, UserFile
 from django.contrib import messages # Import messages framework
-from .forms import UsernameForm, UploadForm, DownloadForm # We'll create forms next
+from .forms import UsernameForm, UploadForm, DownloadForm, AppendForm # We'll create forms next
 from django.views.decorators.http import require_POST # Ensure POST method
-from .encryption_utils import encrypt_file, split_file
+from .encryption_utils import CYPHER_BLOCK_SIZE, encrypt_append, encrypt_file, split_file
+from .admission import AdmissionRejected, admit, exclusive
 from .decryption_utils import combine_files, decrypt_file
+from .integrity import ChunkIntegrityError, PlaintextIntegrityError, hash_file, new_hasher, root_digest
+from .key_utils import check_key, clear_wrong_keys, key_attempts_blocked, make_key_verifier, record_wrong_key
+from .profiling import profile_view, tag_file_size
+from .serving import claim, issue_token, serve_file
 import os
 import uuid
 import shutil # For cleaning up temporary files
@@ -27,6 +32,7 @@ def index_view(request):
         form = UsernameForm()
     return render(request, 'storage/index.html', {'form': form})
 
+@profile_view
 def upload_page_view(request):
     """Page 3: Handle file upload."""
     username = request.session.get('username')
@@ -34,9 +40,17 @@ def upload_page_view(request):
         return redirect('storage:index') # Redirect if username not in session
 
     file_key_p = None # To display the key after upload
+    status, retry_after = 200, None
 
     if request.method == 'POST':
         form = UploadForm(request.POST, request.FILES)
+        # Reserve the quota up front, before any encryption work (ciphertext is CYPHER_BLOCK_SIZE bytes per byte)
+        reserved_bytes = 0
+        if form.is_valid():
+            reserved_bytes = request.FILES['file'].size * CYPHER_BLOCK_SIZE
+            if not StorageUsage.reserve(username, reserved_bytes):
+                reserved_bytes = 0
+                form.add_error('file', "Not enough storage space left for this file.")
         if form.is_valid():
             uploaded_file = request.FILES['file']
             desired_filename = form.cleaned_data['filename']
@@ -44,65 +58,95 @@ def upload_page_view(request):
             os.makedirs(temp_dir, exist_ok=True)
             temp_file_path = os.path.join(temp_dir, uploaded_file.name)
 
-            # 1. Save uploaded file temporarily
-            with open(temp_file_path, 'wb+') as destination:
-                for chunk in uploaded_file.chunks():
-                    destination.write(chunk)
-
-            # 2. Encrypt the temporary file
-            unique_id = uuid.uuid4().hex # Unique identifier for filenames
-            encrypted_filename_base = f"{username}_{unique_id}"
-            encrypted_file_path, p, q, n = encrypt_file(temp_file_path, encrypted_filename_base)
-
-            if encrypted_file_path and p and q and n:
-                # 3. Split the encrypted file
-                location1, location2, location3 = split_file(encrypted_file_path)
-
-                if location1 is not None: # Check if splitting was successful
-                    # 4. Save file info to database
-                    UserFile.objects.create(
-                        username=username,
-                        original_filename=desired_filename or uploaded_file.name, # Use desired or original
-                        encrypted_filename=os.path.basename(encrypted_file_path),
-                        stored_key_part=str(q), # Store prime q
-                        location1=location1,
-                        location2=location2, # Can be None
-                        location3=location3  # Can be None
-                    )
-                    file_key_p = p # Set the key to display to the user
-                    print(f"File {desired_filename or uploaded_file.name} uploaded successfully for {username}.")
-                    form = UploadForm() # Reset form after successful upload
-                else:
-                    print("Error: File splitting failed.")
-                    # Clean up encrypted file if splitting failed
-                    if os.path.exists(encrypted_file_path):
-                        os.remove(encrypted_file_path)
-                    # Add error message to form or context
-            else:
-                print("Error: File encryption failed.")
-                # Add error message to form or context
+            encrypted_file_path = None
 
-            # 5. Clean up temporary file
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
             try:
-                if not os.listdir(temp_dir): # Remove temp dir if empty
-                    os.rmdir(temp_dir)
-            except OSError:
-                 pass # Ignore if removal fails (e.g., race condition)
+                # 1. Save uploaded file temporarily, hashing the plaintext as it streams in
+                plaintext_hasher = new_hasher()
+                with open(temp_file_path, 'wb+') as destination:
+                    for chunk in uploaded_file.chunks():
+                        plaintext_hasher.update(chunk)
+                        destination.write(chunk)
+
+                # 2-4. Encrypt, split and record, once the admission scheduler has a slot for this job
+                try:
+                    with admit(username, uploaded_file.size):
+                        # 2. Encrypt the temporary file
+                        unique_id = uuid.uuid4().hex # Unique identifier for filenames
+                        encrypted_filename_base = f"{username}_{unique_id}"
+                        encrypted_file_path, p, q, n = encrypt_file(temp_file_path, encrypted_filename_base)
+
+                        if encrypted_file_path and p and q and n:
+                            # 3. Split the encrypted file
+                            ciphertext_size = os.path.getsize(encrypted_file_path)
+                            location1, location2, location3, chunk_digests = split_file(encrypted_file_path)
+
+                            if location1 is not None: # Check if splitting was successful
+                                # 4. Save file info to database
+                                UserFile.objects.create(
+                                    username=username,
+                                    original_filename=desired_filename or uploaded_file.name, # Use desired or original
+                                    encrypted_filename=os.path.basename(encrypted_file_path),
+                                    stored_key_part=str(q), # Store prime q
+                                    location1=location1,
+                                    location2=location2, # Can be None
+                                    location3=location3, # Can be None
+                                    plaintext_digest=plaintext_hasher.hexdigest(),
+                                    chunk_digests=chunk_digests,
+                                    ciphertext_digest=root_digest(chunk_digests),
+                                    key_verifier=make_key_verifier(p),
+                                    plaintext_size=uploaded_file.size,
+                                    ciphertext_size=ciphertext_size,
+                                    stored_size=ciphertext_size, # The parts partition the ciphertext
+                                )
+                                # The stored bytes were reserved up front; only correct any difference
+                                StorageUsage.record(username, files=1, plaintext_bytes=uploaded_file.size,
+                                                    ciphertext_bytes=ciphertext_size, stored_bytes=ciphertext_size - reserved_bytes)
+                                reserved_bytes = 0
+                                file_key_p = p # Set the key to display to the user
+                                print(f"File {desired_filename or uploaded_file.name} uploaded successfully for {username}.")
+                                form = UploadForm() # Reset form after successful upload
+                            else:
+                                print("Error: File splitting failed.")
+                                form.add_error(None, "Error storing the encrypted file. Please try again.")
+                        else:
+                            print("Error: File encryption failed.")
+                            form.add_error(None, "Error encrypting the file. Please try again.")
+                except AdmissionRejected as e:
+                    print(f"Upload for {username} rejected by admission control: {e}")
+                    form.add_error(None, "The server is busy encrypting other files. Please try again in a moment.")
+                    status, retry_after = 429, e.retry_after
+            finally:
+                if reserved_bytes: # The upload did not complete; give the reserved bytes back
+                    StorageUsage.release(username, reserved_bytes)
+
+                # 5. Clean up temporary files, also when the upload failed with an exception
+                if os.path.exists(temp_file_path):
+                    os.remove(temp_file_path)
+                if encrypted_file_path and os.path.exists(encrypted_file_path): # Only the split parts are kept
+                    os.remove(encrypted_file_path)
+                try:
+                    if not os.listdir(temp_dir): # Remove temp dir if empty
+                        os.rmdir(temp_dir)
+                except OSError:
+                     pass # Ignore if removal fails (e.g., race condition)
 
 
         # Else (form not valid): Fall through to render the form with errors
     else:
         form = UploadForm()
 
-    return render(request, 'storage/upload_page.html', {
+    response = render(request, 'storage/upload_page.html', {
         'form': form,
         'username': username,
         'file_key_p': file_key_p # Pass the key to the template
-        })
+        }, status=status)
+    if retry_after is not None:
+        response['Retry-After'] = str(retry_after)
+    return response
 
 @require_POST # Ensures this view only accepts POST requests
+@profile_view
 def delete_file_view(request, file_id):
     """Handles the deletion of a file record and its associated chunks."""
     username = request.session.get('username')
@@ -113,87 +157,210 @@ def delete_file_view(request, file_id):
 
     # Get the file record, ensuring it belongs to the current user
     file_record = get_object_or_404(UserFile, id=file_id, username=username)
+    tag_file_size(request, file_record.plaintext_size)
 
-    # --- File Deletion Logic ---
-    error_occurred = False
-
-    # 1. Delete file chunks
-    part_paths = [file_record.location1, file_record.location2, file_record.location3]
-    chunk_dir = None
-    for part_rel_path in part_paths:
-        if part_rel_path: # Ensure path is not None
-            part_full_path = os.path.join(settings.MEDIA_ROOT, part_rel_path)
-            if chunk_dir is None: # Get the directory from the first valid part
-                 chunk_dir = os.path.dirname(part_full_path)
+    # Deletes and appends of the same file are serialized; re-read the row once no append is running
+    with exclusive(f"append_{file_record.id}"):
+        try:
+            file_record.refresh_from_db()
+        except UserFile.DoesNotExist:
+            messages.info(request, "The file was already deleted.")
+            return redirect('storage:download_list')
+
+        # --- File Deletion Logic ---
+        error_occurred = False
+
+        # 1. Delete file chunks
+        chunk_dir = None
+        for part_rel_path in file_record.part_paths:
+            if part_rel_path: # Ensure path is not None
+                part_full_path = os.path.join(settings.MEDIA_ROOT, part_rel_path)
+                if chunk_dir is None: # Get the directory from the first valid part
+                     chunk_dir = os.path.dirname(part_full_path)
+                try:
+                    if os.path.exists(part_full_path):
+                        os.remove(part_full_path)
+                        print(f"Deleted chunk: {part_full_path}")
+                except OSError as e:
+                    print(f"Error deleting chunk {part_full_path}: {e}")
+                    messages.error(request, f"Error deleting part of file {file_record.original_filename}.")
+                    error_occurred = True
+                    # Decide if you want to stop or continue trying to delete other parts/record
+
+        # 2. Attempt to delete the chunk directory if it exists and is empty
+        if chunk_dir and os.path.exists(chunk_dir):
             try:
-                if os.path.exists(part_full_path):
-                    os.remove(part_full_path)
-                    print(f"Deleted chunk: {part_full_path}")
+                # Check if directory is empty AFTER attempting to delete files
+                if not os.listdir(chunk_dir):
+                    os.rmdir(chunk_dir)
+                    print(f"Deleted chunk directory: {chunk_dir}")
             except OSError as e:
-                print(f"Error deleting chunk {part_full_path}: {e}")
-                messages.error(request, f"Error deleting part of file {file_record.original_filename}.")
-                error_occurred = True
-                # Decide if you want to stop or continue trying to delete other parts/record
-
-    # 2. Attempt to delete the chunk directory if it exists and is empty
-    if chunk_dir and os.path.exists(chunk_dir):
+                # Ignore error if directory is not empty or other issues occur
+                print(f"Could not remove chunk directory {chunk_dir}: {e}")
+                pass # Don't flag as error if dir removal fails, main parts deleted are key
+
+        # 3. Delete the main encrypted file (optional - depends if you keep it after splitting)
+        # Check if your workflow keeps the combined encrypted file after splitting.
+        # If encrypt_file saves it and split_file just reads it, you might need to delete it.
+        # Let's assume the main encrypted file might exist in 'MEDIA_ROOT/encrypted/'
+        encrypted_file_path = os.path.join(settings.MEDIA_ROOT, 'encrypted', file_record.encrypted_filename)
         try:
-            # Check if directory is empty AFTER attempting to delete files
-            if not os.listdir(chunk_dir):
-                os.rmdir(chunk_dir)
-                print(f"Deleted chunk directory: {chunk_dir}")
+             if os.path.exists(encrypted_file_path):
+                  os.remove(encrypted_file_path)
+                  print(f"Deleted encrypted file: {encrypted_file_path}")
         except OSError as e:
-            # Ignore error if directory is not empty or other issues occur
-            print(f"Could not remove chunk directory {chunk_dir}: {e}")
-            pass # Don't flag as error if dir removal fails, main parts deleted are key
-
-    # 3. Delete the main encrypted file (optional - depends if you keep it after splitting)
-    # Check if your workflow keeps the combined encrypted file after splitting.
-    # If encrypt_file saves it and split_file just reads it, you might need to delete it.
-    # Let's assume the main encrypted file might exist in 'MEDIA_ROOT/encrypted/'
-    encrypted_file_path = os.path.join(settings.MEDIA_ROOT, 'encrypted', file_record.encrypted_filename)
-    try:
-         if os.path.exists(encrypted_file_path):
-              os.remove(encrypted_file_path)
-              print(f"Deleted encrypted file: {encrypted_file_path}")
-    except OSError as e:
-          print(f"Error deleting encrypted file {encrypted_file_path}: {e}")
-          messages.error(request, f"Could not delete main encrypted file for {file_record.original_filename}.")
-          # Depending on severity, you might set error_occurred = True
-
-    # 4. Delete the database record (only if file deletions were mostly successful, or always attempt?)
-    # Let's attempt deletion even if some file parts failed to delete, but log errors.
-    try:
-        original_filename = file_record.original_filename # Save name for message
-        file_record.delete()
-        print(f"Deleted database record for: {original_filename}")
-        if not error_occurred:
-             messages.success(request, f"Successfully deleted '{original_filename}'.")
-        else:
-             messages.warning(request, f"Deleted database record for '{original_filename}', but encountered errors deleting some associated files.")
+              print(f"Error deleting encrypted file {encrypted_file_path}: {e}")
+              messages.error(request, f"Could not delete main encrypted file for {file_record.original_filename}.")
+              # Depending on severity, you might set error_occurred = True
+
+        # 4. Delete the database record (only if file deletions were mostly successful, or always attempt?)
+        # Let's attempt deletion even if some file parts failed to delete, but log errors.
+        try:
+            original_filename = file_record.original_filename # Save name for message
+            file_record.delete()
+            StorageUsage.record(username, files=-1, plaintext_bytes=-file_record.plaintext_size,
+                                ciphertext_bytes=-file_record.ciphertext_size, stored_bytes=-file_record.stored_size)
+            print(f"Deleted database record for: {original_filename}")
+            if not error_occurred:
+                 messages.success(request, f"Successfully deleted '{original_filename}'.")
+            else:
+                 messages.warning(request, f"Deleted database record for '{original_filename}', but encountered errors deleting some associated files.")
 
-    except Exception as e:
-        print(f"Error deleting database record for file ID {file_id}: {e}")
-        messages.error(request, f"Failed to delete the database record for '{file_record.original_filename}'.")
+        except Exception as e:
+            print(f"Error deleting database record for file ID {file_id}: {e}")
+            messages.error(request, f"Failed to delete the database record for '{file_record.original_filename}'.")
 
 
     # 5. Redirect back to the download list
     return redirect('storage:download_list')
 
 
-def download_list_view(request):
-    """Page 2 (Part 1): Show list of files for the user."""
+@require_POST
+@profile_view
+def append_file_view(request, file_id):
+    """Appends data to an existing file, encrypting only the new bytes into an extra part."""
     username = request.session.get('username')
     if not username:
+        messages.error(request, "Session expired. Please enter username again.")
         return redirect('storage:index')
 
+    file_record = get_object_or_404(UserFile, id=file_id, username=username)
+    form = AppendForm(request.POST, request.FILES)
+    if not form.is_valid():
+        messages.error(request, 'Invalid append request: ' + ' '.join(e for errors in form.errors.values() for e in errors))
+        return _render_download_list(request, username)
+    try:
+        user_key_p = int(form.cleaned_data['file_key'])
+    except ValueError:
+        messages.error(request, 'Invalid file key format. Please enter a number.')
+        return _render_download_list(request, username)
+    delta_file = request.FILES['file']
+    tag_file_size(request, delta_file.size)
+
+    # 1. Check the key against the stored verifier; a wrong key would corrupt the file for good
+    if key_attempts_blocked(username, file_id):
+        messages.error(request, 'Too many incorrect file keys for this file. Please try again later.')
+        response = _render_download_list(request, username, status=429)
+        response['Retry-After'] = str(getattr(settings, 'STORAGE_KEY_ATTEMPT_WINDOW', 300))
+        return response
+    key_matches = check_key(user_key_p, file_record.key_verifier)
+    if key_matches is None:
+        messages.error(request, f"'{file_record.original_filename}' was uploaded before appends were supported. Please upload it again.")
+        return _render_download_list(request, username)
+    if not key_matches:
+        record_wrong_key(username, file_id)
+        messages.error(request, 'Incorrect file key.')
+        return _render_download_list(request, username)
+    clear_wrong_keys(username, file_id)
+
+    delta_ciphertext_size = delta_file.size * CYPHER_BLOCK_SIZE
+    if not StorageUsage.reserve(username, delta_ciphertext_size):
+        messages.error(request, 'Not enough storage space left for this append.')
+        return _render_download_list(request, username)
+    reserved_bytes = delta_ciphertext_size
+
+    # 2. Save the new bytes temporarily, hashing them as they stream in
+    temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_file_path = os.path.join(temp_dir, f"append_{uuid.uuid4().hex}.tmp")
+    delta_hasher = new_hasher()
+    try:
+        with open(temp_file_path, 'wb') as destination:
+            for chunk in delta_file.chunks():
+                delta_hasher.update(chunk)
+                destination.write(chunk)
+
+        # 3. Encrypt only the new bytes with the file's modulus, as the next part. Appends (and deletes)
+        # of the same file are serialized so parts are numbered and recorded in order.
+        with admit(username, delta_file.size), exclusive(f"append_{file_record.id}"):
+            try:
+                file_record.refresh_from_db()
+            except UserFile.DoesNotExist: # Deleted while this request waited for the lock
+                messages.error(request, f"'{file_record.original_filename}' was deleted. Nothing was appended.")
+                return _render_download_list(request, username)
+            n = user_key_p * int(file_record.stored_key_part)
+            chunk_dir = os.path.dirname(os.path.join(settings.MEDIA_ROOT, file_record.location1))
+            # The next part number is never one of the recorded parts, so a file already at that path
+            # is a leftover of a failed append and is overwritten
+            part_full_path = os.path.join(chunk_dir, f"part_{len(file_record.part_paths) + 1}")
+            if not encrypt_append(temp_file_path, part_full_path, n):
+                messages.error(request, 'Error encrypting the appended data. Nothing was changed.')
+                return _render_download_list(request, username)
+
+            # 4. Record the part; digests and sizes are updated from the new part alone. The appended
+            # bytes get their own plaintext digest, so downloads can verify every segment.
+            file_record.extra_locations = file_record.extra_locations + [os.path.relpath(part_full_path, settings.MEDIA_ROOT)]
+            file_record.plaintext_segments = file_record.plaintext_segments + [[delta_file.size, delta_hasher.hexdigest()]]
+            if file_record.chunk_digests:
+                file_record.chunk_digests = file_record.chunk_digests + [hash_file(part_full_path)]
+                file_record.ciphertext_digest = root_digest(file_record.chunk_digests)
+            file_record.plaintext_size += delta_file.size
+            file_record.ciphertext_size += delta_ciphertext_size
+            file_record.stored_size += delta_ciphertext_size
+            file_record.save(update_fields=['extra_locations', 'chunk_digests', 'ciphertext_digest', 'plaintext_segments',
+                                            'plaintext_size', 'ciphertext_size', 'stored_size'])
+            StorageUsage.record(username, plaintext_bytes=delta_file.size, ciphertext_bytes=delta_ciphertext_size)
+            reserved_bytes = 0 # Reserved up front, now used by the new part
+    except AdmissionRejected as e:
+        print(f"Append for {username} rejected by admission control: {e}")
+        messages.error(request, 'The server is busy encrypting other files. Please try again in a moment.')
+        response = _render_download_list(request, username, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    finally:
+        if reserved_bytes: # The append did not complete; give the reserved bytes back
+            StorageUsage.release(username, reserved_bytes)
+        # 5. Clean up temporary file
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+    print(f"Appended {delta_file.size} bytes to {file_record.original_filename} for {username}.")
+    messages.success(request, f"Appended {delta_file.size} bytes to '{file_record.original_filename}'.")
+    return redirect('storage:download_list')
+
+
+def _render_download_list(request, username, status=200):
+    """Renders the user's file list with per-file sizes and the usage totals (no filesystem access)."""
     user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
+    usage = StorageUsage.objects.filter(username=username).first()
     return render(request, 'storage/download_list.html', {
         'username': username,
-        'files': user_files
-        })
+        'files': user_files,
+        'usage': usage,
+        'quota_bytes': StorageUsage.quota_for(usage),
+        }, status=status)
 
 
+def download_list_view(request):
+    """Page 2 (Part 1): Show list of files for the user."""
+    username = request.session.get('username')
+    if not username:
+        return redirect('storage:index')
+
+    return _render_download_list(request, username)
+
+
+@profile_view
 def download_file_view(request):
     """Page 2 (Part 2): Handle file download action."""
     username = request.session.get('username')
@@ -209,29 +376,40 @@ def download_file_view(request):
             try:
                 user_key_p = int(user_key_p_str)
             except (ValueError, TypeError):
-                user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
                 messages.error(request, 'Invalid file key format. Please enter a number.')
-                return render(request, 'storage/download_list.html', {
-                    'username': username,
-                    'files': user_files,
-                })
+                return _render_download_list(request, username)
 
 
             try:
                 file_record = UserFile.objects.get(id=file_id, username=username)
             except UserFile.DoesNotExist:
                 raise Http404("File not found or access denied.")
+            tag_file_size(request, file_record.plaintext_size)
+
+            # Reject wrong keys against the stored verifier before any chunk I/O, and throttle retries
+            if key_attempts_blocked(username, file_id):
+                messages.error(request, 'Too many incorrect file keys for this file. Please try again later.')
+                response = _render_download_list(request, username, status=429)
+                response['Retry-After'] = str(getattr(settings, 'STORAGE_KEY_ATTEMPT_WINDOW', 300))
+                return response
+            key_matches = check_key(user_key_p, file_record.key_verifier) # None for files without a verifier
+            if key_matches is None:
+                # The key cannot be checked up front, so every attempt costs a full decryption; count
+                # them all against the same limit
+                record_wrong_key(username, file_id)
+            if key_matches is False:
+                record_wrong_key(username, file_id)
+                messages.error(request, 'Incorrect file key.')
+                return _render_download_list(request, username)
+            if key_matches:
+                clear_wrong_keys(username, file_id)
 
             try:
                 stored_key_q = int(file_record.stored_key_part)
             except (ValueError, TypeError):
                 print(f"Error: Stored key for file {file_id} is invalid.")
-                user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
                 messages.error(request, 'Error retrieving stored key. Cannot decrypt.')
-                return render(request, 'storage/download_list.html', {
-                    'username': username,
-                    'files': user_files,
-                })
+                return _render_download_list(request, username)
 
             # Ensure the original filename ends with .txt (it should, due to upload validation)
             download_filename = file_record.original_filename
@@ -251,70 +429,74 @@ def download_file_view(request):
             decrypted_file_path = os.path.join(temp_decrypted_dir, temp_decrypted_filename)
 
 
-            # 1. Combine file parts
-            part_paths = [file_record.location1, file_record.location2, file_record.location3]
-            if not combine_files(part_paths, combined_encrypted_path):
-                print("Error: Failed to combine file parts.")
-                if os.path.exists(combined_encrypted_path): os.remove(combined_encrypted_path)
-                user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
-                messages.error(request, 'Error combining file parts. Download failed.')
-                return render(request, 'storage/download_list.html', {
-                    'username': username,
-                    'files': user_files,
-                })
-
-            # 2. Decrypt the combined file
-            decryption_success = decrypt_file(combined_encrypted_path, decrypted_file_path, user_key_p, stored_key_q)
-
-            # 3. Clean up combined encrypted file
-            if os.path.exists(combined_encrypted_path): os.remove(combined_encrypted_path)
+            # 1-3. Combine and decrypt, once the admission scheduler has a slot for this job
             try:
-                if not os.listdir(temp_combined_dir): os.rmdir(temp_combined_dir)
-            except OSError: pass
+                with admit(username, file_record.plaintext_size):
+                    # 1. Combine file parts, verifying each part's checksum as it is copied
+                    chunk_digests = file_record.chunk_digests
+                    try:
+                        if chunk_digests and root_digest(chunk_digests) != file_record.ciphertext_digest:
+                            raise ChunkIntegrityError('chunk_digests', file_record.ciphertext_digest, root_digest(chunk_digests))
+                        combined = combine_files(file_record.part_paths, combined_encrypted_path, chunk_digests)
+                    except ChunkIntegrityError as e:
+                        print(f"Error: Integrity check failed for file {file_id}: {e}")
+                        messages.error(request, 'This file is corrupted (checksum mismatch). Download aborted.')
+                        return _render_download_list(request, username)
+                    if not combined:
+                        print("Error: Failed to combine file parts.")
+                        messages.error(request, 'Error combining file parts. Download failed.')
+                        return _render_download_list(request, username)
+
+                    # 2. Decrypt the combined file, checking each uploaded or appended segment of the output
+                    # against its recorded plaintext digest
+                    try:
+                        decryption_success = decrypt_file(combined_encrypted_path, decrypted_file_path,
+                                                          user_key_p, stored_key_q, file_record.plaintext_checks)
+                    except PlaintextIntegrityError as e:
+                        print(f"Error: Plaintext integrity check failed for file {file_id}: {e}")
+                        messages.error(request, 'The decrypted file does not match its checksum. Download aborted.')
+                        return _render_download_list(request, username)
+            except AdmissionRejected as e:
+                print(f"Download for {username} rejected by admission control: {e}")
+                messages.error(request, 'The server is busy decrypting other files. Please try again in a moment.')
+                response = _render_download_list(request, username, status=429)
+                response['Retry-After'] = str(e.retry_after)
+                return response
+            finally:
+                # 3. Clean up combined encrypted file, whichever way the steps above ended
+                if os.path.exists(combined_encrypted_path): os.remove(combined_encrypted_path)
+                try:
+                    if not os.listdir(temp_combined_dir): os.rmdir(temp_combined_dir)
+                except OSError: pass
 
             if decryption_success:
-                # 4. Serve the decrypted file for download
-                try:
-                    with open(decrypted_file_path, 'rb') as f:
-                        # *** CHANGE HERE: Set Content-Type to text/plain ***
-                        response = HttpResponse(f.read(), content_type='text/plain')
-                        # Ensure filename in header ends with .txt
-                        response['Content-Disposition'] = f'attachment; filename="{download_filename}"'
-
-                    # 5. Clean up decrypted file after serving
-                    if os.path.exists(decrypted_file_path): os.remove(decrypted_file_path)
-                    try:
-                        if not os.listdir(temp_decrypted_dir): os.rmdir(temp_decrypted_dir)
-                    except OSError: pass
-                    return response
-
-                except IOError:
-                    print("Error: Could not read decrypted file for download.")
-                    # Clean up potentially failed decrypted file before raising Http404
-                    if os.path.exists(decrypted_file_path): os.remove(decrypted_file_path)
-                    raise Http404("Error preparing file for download.")
+                # 4. Hand the decrypted file to the serving endpoint with a single-use, expiring token.
+                # Depending on STORAGE_SERVE_BACKEND the bytes are then sent by Nginx/Apache or via sendfile.
+                token = issue_token(decrypted_file_path, download_filename, username)
+                return redirect('storage:serve_download', token=token)
             else:
                 print("Error: Decryption failed (likely incorrect key or corrupted data).")
                 if os.path.exists(decrypted_file_path): os.remove(decrypted_file_path)
-                user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
                 messages.error(request, 'Decryption failed. Check your file key or the file might be corrupted.')
-                return render(request, 'storage/download_list.html', {
-                    'username': username,
-                    'files': user_files,
-                })
+                return _render_download_list(request, username)
 
         else: # Form not valid
             print("Download form invalid:", form.errors)
              # Re-render download list with form errors if needed, or just redirect
-            user_files = UserFile.objects.filter(username=username).order_by('-upload_date')
             # You might want to pass the specific form errors back to the template
             # For simplicity here, just add a general error message
             messages.error(request, 'Invalid download request.')
-            return render(request, 'storage/download_list.html', {
-                 'username': username,
-                 'files': user_files,
-            })
+            return _render_download_list(request, username)
 
 
     # If GET request
-    return redirect('storage:download_list')
\ No newline at end of file
+    return redirect('storage:download_list')
+
+def serve_download_view(request, token):
+    """Page 2 (Part 3): Serve a decrypted file once, given the token issued by download_file_view."""
+    username = request.session.get('username')
+    if not username:
+        return redirect('storage:index')
+
+    served_path, download_filename = claim(token, username)
+    return serve_file(served_path, download_filename)